@@ -71,6 +71,7 @@ setup(
             'swfoldersize.py=swift_commander.swfoldersize:main',
             'swhashcomp.py=swift_commander.swhashcomp:main',
             'swpget.py=swift_commander.swpget:main',
+            'swpput.py=swift_commander.swpput:main',
             'swrm.py=swift_commander.swrm:main',
             'swsearch.py=swift_commander.swsearch:main',
             'swsymlinks.py=swift_commander.swsymlinks:main',
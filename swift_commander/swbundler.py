@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-import os,sys,getopt,tarfile
+import os,sys,getopt,tarfile,json,zlib,bz2,lzma,fnmatch,itertools
 import getpass
 
 from distutils.spawn import find_executable
 
 import time
+import stat
+import queue
 import socket
 import optparse
+import hashlib
+import threading
 import subprocess
 import multiprocessing
+from urllib.parse import quote,unquote
 
 from swiftclient import Connection
 
@@ -32,6 +37,27 @@ swift_auth=os.environ.get("ST_AUTH")
 swift_auth_token=os.environ.get("OS_AUTH_TOKEN")
 storage_url=os.environ.get("OS_STORAGE_URL")
 haz_pigz=False
+index_members=False
+# digests: md5 of every member and of the whole tar, kept next to the bundle
+digests=False
+# archive engine, "tar" forks tar per bundle, "python" works in process
+engine="tar"
+verbose=True
+# bundle compression: gzip, pigz, zstd, lz4, none or auto, None keeps the
+# original behaviour (pigz if found else uncompressed, python engine gzip)
+codec=None
+auto_codec="gzip"
+# threads listing directories, 1 walks with a single os.walk
+walkers=1
+# TempBudget shared by pool workers creating or downloading temp bundles
+temp_budget=None
+# expand mode: directories are unpacked by the bulk middleware into one
+# object per file instead of being stored as bundles
+expand=False
+# CpuBudget sharing cores between the compressors of pool workers and the
+# threads this worker's compressor gets, 0 leaves the compressor's default
+cpu_budget=None
+compress_threads=0
 
 # define minimum parser object(s) to allow swiftstack shell to run 
 # old is pre swiftclient 3.1 and new is 3.1+
@@ -136,7 +162,7 @@ if parse_version(swiftclient.__version__)<parse_version('3.1.0'):
 else:
    shell_minimal_options = shell_new_minimal_options
 
-# wrapper function for swiftstack shell functions
+# wrapper function for swiftstack shell functions, True if no errors
 def sw_shell(sw_fun,*args):
    global swift_auth_token,storage_url
 
@@ -151,12 +177,14 @@ def sw_shell(sw_fun,*args):
          sw_fun(parser, list(args), output)
       except (ClientException, RequestException, socket.error) as err:
          output.error(str(err))
+
+   return output.error_count==0
  
 def sw_download(*args):
-   sw_shell(shell.st_download,*args)
+   return sw_shell(shell.st_download,*args)
  
 def sw_upload(*args):
-   sw_shell(shell.st_upload,*args)
+   return sw_shell(shell.st_upload,*args)
  
 def sw_post(*args):
    sw_shell(shell.st_post,*args)
@@ -164,6 +192,67 @@ def sw_post(*args):
 # suffix of archive files
 tar_suffix=".tar.gz"
 root_id=".root"
+# name of the per-prefix catalog of directory fingerprints (incremental mode)
+catalog_id=".swbundler-catalog.json"
+# pack mode: bundles of coalesced directories and the directory->bundle index
+pack_id=".swbundler-pack"
+index_id=".swbundler-index.json"
+# member index stored next to a bundle, pre_path+members_suffix
+members_suffix=".members.json"
+# member digests stored next to a bundle, pre_path+digests_suffix
+digests_suffix=".digests.json"
+# files split out of their directory into a bundle of their own,
+# pre_path/file+split_id
+split_id=".swbundler-file"
+# local journal of finished bundles, kept in tmp_dir or the home directory
+journal_id=".swbundler-journal"
+# size and etag of the last bundle uploaded by a worker when track_uploads
+# is set for the journal, a temp file's etag is None and is taken from the
+# container listing at the end of the run
+upload_info=None
+track_uploads=False
+
+# SLO segment size, read size for streamed bundles and how much of a stream
+# is held in memory before deciding it needs to be segmented at all
+segment_size=2147483648
+stream_chunk_size=65536
+stream_buffer_size=67108864
+# chunks buffered between two pipeline stages for each bundle
+pipeline_queue_size=64
+
+# compressor commands, tar adds -d itself when extracting, gzip and none are
+# done in process by the python engine
+codec_commands={
+   "gzip":["gzip","-c"],
+   "pigz":["pigz","-c"],
+   "zstd":["zstd","-q","-c"],
+   "lz4":["lz4","-q","-c"],
+}
+# extract-archive formats the bulk middleware takes, by codec, and how often
+# members it failed to create are sent again
+expand_formats={
+   "gzip":"tar.gz",
+   "pigz":"tar.gz",
+   "none":"tar",
+}
+expand_retries=3
+
+# thread count option of multithreaded compressors
+codec_threads={
+   "pigz":"-p",
+   "zstd":"-T",
+}
+codec_magic=[
+   (b'\x1f\x8b',"gzip"),
+   (b'\x28\xb5\x2f\xfd',"zstd"),
+   (b'\x04\x22\x4d\x18',"lz4"),
+   (b'BZh',"bzip2"),
+   (b'\xfd7zXZ',"xz"),
+]
+# files with these suffixes are taken as already compressed by codec auto
+compressed_suffixes=('.bam','.cram','.gz','.tgz','.bz2','.xz','.zst','.lz4',
+   '.zip','.7z','.tif','.tiff','.jpg','.jpeg','.png','.gif','.mov','.avi',
+   '.mp4','.nd2','.h5')
 
 # True if 1st char of path member is '.' else False
 def is_hidden_dir(dir_name):
@@ -173,6 +262,92 @@ def is_hidden_dir(dir_name):
 
    return False
 
+class TempBudget:
+   """ bytes of temp space shared by forked pool workers """
+   def __init__(self,size):
+      self.size=size
+      self.used=multiprocessing.Value('q',0,lock=False)
+      self.cond=multiprocessing.Condition()
+
+   # blocks until size fits, a job larger than the budget runs on its own
+   def reserve(self,size):
+      size=min(size,self.size)
+      with self.cond:
+         while self.used.value and self.used.value+size>self.size:
+            self.cond.wait()
+         self.used.value+=size
+
+      return size
+
+   def release(self,size):
+      with self.cond:
+         self.used.value-=size
+         self.cond.notify_all()
+
+def reserve_temp(size):
+   global temp_budget
+
+   if temp_budget:
+      return temp_budget.reserve(size)
+
+   return 0
+
+def release_temp(size):
+   global temp_budget
+
+   if temp_budget:
+      temp_budget.release(size)
+
+class CpuBudget:
+   """ cores shared by the compressors of forked pool workers """
+   def __init__(self,cpus,jobs=1):
+      self.cpus=cpus
+      self.jobs=jobs
+      self.active=multiprocessing.Value('i',0)
+      self.granted=multiprocessing.Value('i',0,lock=False)
+
+   # threads for a starting job out of those not yet handed out, an even
+   # share between the jobs the pool runs at once so the first ones don't
+   # take it all; a job always gets one
+   def start(self):
+      with self.active.get_lock():
+         self.active.value+=1
+         threads=max(1,min(self.cpus-self.granted.value,
+            self.cpus//max(self.active.value,self.jobs)))
+         self.granted.value+=threads
+         return threads
+
+   # threads is what start returned for the job
+   def finish(self,threads):
+      with self.active.get_lock():
+         self.active.value-=1
+         self.granted.value-=threads
+
+# compressor options giving it this worker's share of threads
+def codec_thread_args(codec):
+   global codec_threads,compress_threads
+
+   if compress_threads and codec in codec_threads:
+      return [codec_threads[codec]+str(compress_threads)]
+
+   return []
+
+def codec_command(codec):
+   global codec_commands
+
+   return codec_commands[codec]+codec_thread_args(codec)
+
+# user+system seconds of this process and of its finished children
+def cpu_times():
+   times=os.times()
+   return times[0]+times[1],times[2]+times[3]
+
+def print_cpu(stages,wall,cpus):
+   wall=max(wall,1e-6)
+   print_flush("cpu: %s, wall %.1fs on %d cores" % 
+      (", ".join("%s %.1fs (%.1f cores)" % (stage,seconds,seconds/wall) 
+         for stage,seconds in stages),wall,cpus))
+
 def print_flush(str):
    sys.stdout.write(str+'\n')
    sys.stdout.flush()
@@ -181,25 +356,114 @@ def print_flush(str):
 def unique_id():
    return str(os.getpid())
 
-def create_tar_file(filename,src_path,file_list,recurse=False):
-   global haz_pigz
+def detect_codec(lead):
+   global codec_magic
+
+   for magic,name in codec_magic:
+      if lead.startswith(magic):
+         return name
+
+   return "none"
+
+def tar_codec_params(codec):
+   global codec_commands
+
+   if codec=="gzip":
+      return ["-z"]
+   if codec=="bzip2":
+      return ["-j"]
+   if codec=="xz":
+      return ["-J"]
+   if codec in codec_commands:
+      return ["--use-compress-program="+" ".join(codec_commands[codec][:1]+
+         codec_thread_args(codec))]
+
+   return []
+
+# estimate from file suffixes and zlib on samples whether compressing the
+# files of a bundle saves at least a tenth of their size
+def is_compressible(src_path,file_list,sample_size=65536,samples=8):
+   global compressed_suffixes
+
+   total=0
+   candidates=[]
+   for file in file_list:
+      path=os.path.join(src_path,file)
+      try:
+         st=os.lstat(path)
+      except OSError:
+         continue
+      if not stat.S_ISREG(st.st_mode):
+         continue
+      total+=st.st_size
+      if not file.lower().endswith(compressed_suffixes):
+         candidates.append([st.st_size,path])
+
+   if not total:
+      return False
+
+   # sample the largest remaining files
+   candidates.sort(reverse=True)
+   raw=packed=0
+   for size,path in candidates[:samples]:
+      try:
+         with open(path,'rb') as f:
+            data=f.read(sample_size)
+      except OSError:
+         continue
+      raw+=len(data)
+      packed+=len(zlib.compress(data,1))
+
+   ratio=packed/raw if raw else 1.0
+   saving=sum(size for size,path in candidates)*(1.0-ratio)
+   return saving>=total/10
+
+def bundle_codec(src_path,file_list,recurse=False):
+   global codec,auto_codec,engine,haz_pigz
+   global index_members
+
+   if codec=="auto":
+      if recurse:
+         file_list=tar_member_names(src_path,file_list,True)
+      name=auto_codec if is_compressible(src_path,file_list) else "none"
+   elif codec:
+      name=codec
+   elif engine=="python":
+      name="gzip"
+   else:
+      name="pigz" if haz_pigz else "none"
+
+   # member frames are only possible in process
+   if index_members and name not in ("gzip","none"):
+      name="gzip"
+
+   return name
+
+def tar_create_params(filename,src_path,recurse=False,codec="none"):
+   global verbose
 
    # only archive src_path directory
-   tar_params=["tar","cvf",filename,"--directory="+src_path]
+   tar_params=["tar","cvf" if verbose else "cf",filename,
+      "--directory="+src_path]
    if not recurse:
       tar_params+=["--no-recursion"]
-   if haz_pigz:
-      tar_params+=["--use-compress-program=pigz"]
+   tar_params+=tar_codec_params(codec)
 
    # include directory itself in archive for ownership & permissions
-   tar_params=tar_params+['.']
+   return tar_params+['.']
+
+def tar_file_list_line(file):
+   return "-- \""+file+"\"\n"
+
+def create_tar_file(filename,src_path,file_list,recurse=False,codec="none"):
+   tar_params=tar_create_params(filename,src_path,recurse,codec)
 
    # generate external file list only if files to be archived
    if file_list:
       tmp_file="/tmp/.tar."+unique_id()
       with open(tmp_file,"w") as f:
          for file in file_list:
-            f.write("-- \""+file+"\"\n")
+            f.write(tar_file_list_line(file))
       tar_params+=["-T",tmp_file]
   
    ret=subprocess.call(tar_params)
@@ -210,60 +474,907 @@ def create_tar_file(filename,src_path,file_list,recurse=False):
    if file_list:
       os.unlink(tmp_file)
 
+   return ret==0
+
+def feed_file_list(pipe,file_list):
+   try:
+      for file in file_list:
+         pipe.write(os.fsencode(tar_file_list_line(file)))
+   finally:
+      pipe.close()
+
+# start tar writing the archive to a pipe, file list is fed through stdin
+# so nothing at all is written locally
+def open_tar_stream(src_path,file_list,recurse=False,codec="none"):
+   tar_params=tar_create_params("-",src_path,recurse,codec)
+   if file_list:
+      tar_params+=["-T","-"]
+
+   proc=subprocess.Popen(tar_params,stdout=subprocess.PIPE,
+      stdin=subprocess.PIPE if file_list else subprocess.DEVNULL)
+   if file_list:
+      threading.Thread(target=feed_file_list,args=(proc.stdin,file_list),
+         daemon=True).start()
+
+   return proc,tar_params
+
 def upload_file_to_swift(filename,swiftname,container,meta):
+   global upload_info,track_uploads
+
    final=[container,filename]
    if meta:
       final=meta+final
 
-   sw_upload("--object-name="+swiftname,
-      "--segment-size=2147483648",
+   if track_uploads:
+      upload_info=(os.path.getsize(filename),None)
+   return sw_upload("--object-name="+swiftname,
+      "--segment-size=%d" % segment_size,
       "--use-slo",
       "--segment-container=.segments_"+container,
       "--header=X-Object-Meta-Uploaded-by:"+getpass.getuser(),*final)
 
+class FrameWriter:
+   """ gzip writer that can end the current gzip member at any point """
+   def __init__(self,out,level=6,compress=True,digest=None):
+      self.out=out
+      self.level=level
+      self.compress=compress
+      self.digest=digest
+      self.pos=0
+      self.out_pos=0
+      self.frame_start=0
+      self.compressor=None
+
+   def tell(self):
+      return self.pos
+
+   def write(self,data):
+      self.pos+=len(data)
+      if self.digest:
+         self.digest.update(data)
+      if not self.compress:
+         self.emit(data)
+         return len(data)
+
+      if self.compressor is None:
+         self.compressor=zlib.compressobj(self.level,zlib.DEFLATED,31)
+      self.emit(self.compressor.compress(data))
+      return len(data)
+
+   def emit(self,data):
+      if data:
+         self.out.write(data)
+         self.out_pos+=len(data)
+
+   def end_frame(self):
+      """ returns compressed offset and length of the frame just ended """
+      if self.compressor is not None:
+         self.emit(self.compressor.flush())
+         self.compressor=None
+      start=self.frame_start
+      self.frame_start=self.out_pos
+      return start,self.out_pos-start
+
+class HashingReader:
+   """ file-like hashing what is read through it """
+   def __init__(self,fileobj):
+      self.fileobj=fileobj
+      self.md5=hashlib.md5()
+
+   def read(self,size=-1):
+      data=self.fileobj.read(size)
+      self.md5.update(data)
+      return data
+
+class PaddingReader:
+   """ file-like giving exactly size bytes of fileobj, padded with zeros if
+      it shrinks or can't be read any more, as GNU tar does """
+   def __init__(self,fileobj,size,path):
+      self.fileobj=fileobj
+      self.remaining=size
+      self.path=path
+      self.short=False
+
+   def read(self,size=-1):
+      if size<0 or size>self.remaining:
+         size=self.remaining
+      data=b''
+      if not self.short:
+         try:
+            data=self.fileobj.read(size)
+         except OSError as err:
+            sys.stderr.write('***** TAR ERROR %s *****\n' % err)
+         if len(data)<size:
+            self.short=True
+            sys.stderr.write('***** TAR WARNING %s: file shrank by %d bytes,'
+               ' padding with zeros *****\n' % (self.path,
+                  self.remaining-len(data)))
+      if len(data)<size:
+         data+=bytes(size-len(data))
+      self.remaining-=len(data)
+      return data
+
+# symlinks to directories are listed in dirs by walk but not descended
+# into, tar archives them as links
+def dir_links(root,dirs):
+   return [name for name in dirs if os.path.islink(os.path.join(root,name))]
+
+def tar_member_names(src_path,file_list,recurse=False):
+   names=['.']+list(file_list)
+   if recurse:
+      names=[]
+      for root,dirs,files in walk(src_path):
+         dirs.sort()
+         rel=os.path.relpath(root,src_path)
+         names+=[rel]+[os.path.normpath(os.path.join(rel,name)) 
+            for name in sorted(files+dir_links(root,dirs))]
+
+   return names
+
+# in process archive engine: write (gzipped) tar of src_path to out, with
+# frames every member gets its own gzip member so that it can be fetched
+# with a range request, returns the member index, with digest the tar is
+# hashed into it and members get the md5 of their content
+def write_tar(out,src_path,file_list,recurse=False,frames=False,
+   compress=True,digest=None):
+   global verbose
+
+   writer=FrameWriter(out,compress=compress,digest=digest)
+   members=[]
+
+   with tarfile.open(fileobj=writer,mode='w',format=tarfile.GNU_FORMAT) as tar:
+      for name in tar_member_names(src_path,file_list,recurse):
+         path=os.path.join(src_path,name)
+         # like tar, members that can't be read are left out with a
+         # warning and the rest of the bundle is written
+         try:
+            info=tar.gettarinfo(path,arcname=name)
+            if info is None:
+               sys.stderr.write('***** TAR WARNING %s: socket ignored '
+                  '*****\n' % path)
+               continue
+            f=open(path,'rb') if info.isreg() else None
+         except OSError as err:
+            sys.stderr.write('***** TAR ERROR %s *****\n' % err)
+            continue
+
+         md5=None
+         if f:
+            with f:
+               reader=PaddingReader(f,info.size,path)
+               if digest:
+                  reader=HashingReader(reader)
+               tar.addfile(info,reader)
+            if digest:
+               md5=reader.md5.hexdigest()
+         else:
+            tar.addfile(info)
+         if verbose:
+            print_flush(info.name)
+
+         offset,length=writer.tell(),0
+         if frames:
+            offset,length=writer.end_frame()
+         members.append({"path":info.name,"offset":offset,"length":length,
+            "size":info.size,"mtime":info.mtime,"mode":info.mode})
+         if md5:
+            members[-1]["md5"]=md5
+
+   # end of archive blocks
+   writer.end_frame()
+   return members
+
+def write_tar_to(out,src_path,file_list,recurse,frames,compress,result,
+   digest=None):
+   try:
+      with out:
+         result.append(write_tar(out,src_path,file_list,recurse,frames,
+            compress,digest))
+   except (OSError, tarfile.TarError) as err:
+      sys.stderr.write('***** TAR ERROR %s: %s *****\n' % (src_path,err))
+
+# python engine version of archive_tar_file, no tar process is started
+# unless the codec needs an external compressor
+def archive_python_file(src_path,file_list,container,tmp_dir,pre_path,meta,
+   recurse=False,stream=False):
+   global tar_suffix,members_suffix,digests_suffix
+   global index_members,digests
+
+   archive_name=pre_path+tar_suffix
+   codec=bundle_codec(src_path,file_list,recurse)
+   meta=meta+["-HX-Object-Meta-Codec:"+codec]
+   compress=(codec=="gzip")
+   program=None
+   if codec not in ("gzip","none"):
+      program=codec_command(codec)
+   result=[]
+   uploaded=False
+   digest=hashlib.md5() if digests else None
+
+   if stream:
+      if program:
+         proc=subprocess.Popen(program,stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+         tar_out,stream_in=proc.stdin,proc.stdout
+      else:
+         r,w=os.pipe()
+         tar_out,stream_in=os.fdopen(w,'wb'),os.fdopen(r,'rb')
+
+      writer=threading.Thread(target=write_tar_to,
+         args=(tar_out,src_path,file_list,recurse,index_members,compress,
+            result,digest))
+      writer.start()
+      with stream_in:
+         try:
+            upload_stream_to_swift(stream_in,archive_name,container,meta)
+            uploaded=True
+         except (ClientException, RequestException, socket.error) as err:
+            sys.stderr.write('***** UPLOAD ERROR %s: %s *****\n' % 
+               (archive_name,err))
+      writer.join()
+   else:
+      temp_archive_name=unique_id()+os.path.basename(archive_name)
+      if tmp_dir:
+         temp_archive_name=os.path.join(tmp_dir,temp_archive_name)
+
+      reserved=reserve_temp(tar_footprint(src_path,file_list,recurse))
+      try:
+         with open(temp_archive_name,'wb') as temp_out:
+            if program:
+               proc=subprocess.Popen(program,stdin=subprocess.PIPE,
+                  stdout=temp_out)
+               tar_out=proc.stdin
+            else:
+               tar_out=temp_out
+            write_tar_to(tar_out,src_path,file_list,recurse,index_members,
+               compress,result,digest)
+
+         if program and proc.wait()>0:
+            result=[]
+         uploaded=upload_file_to_swift(temp_archive_name,archive_name,
+            container,meta)
+      finally:
+         if os.path.exists(temp_archive_name):
+            os.unlink(temp_archive_name)
+         release_temp(reserved)
+
+   if program and proc.wait()>0:
+      sys.stderr.write('***** COMPRESS ERROR %s, command: %s *****\n' % 
+         (proc.returncode,program))
+      result=[]
+
+   if not (result and uploaded):
+      return False
+
+   if index_members:
+      put_json_object(container,pre_path+members_suffix,
+         {"bundle":archive_name,"codec":codec,"members":result[0]})
+   if digests:
+      put_json_object(container,pre_path+digests_suffix,
+         {"bundle":archive_name,"tar_md5":digest.hexdigest(),
+            "members":dict((member["path"],[member["size"],member["md5"]]) 
+               for member in result[0] if "md5" in member)})
+   return True
+
+def meta_to_headers(meta):
+   headers={"X-Object-Meta-Uploaded-by":getpass.getuser()}
+   # meta items are in swift upload form: -HX-Object-Meta-name:value
+   for item in meta:
+      name,value=item[2:].split(':',1)
+      headers[name]=value
+
+   return headers
+
+class SegmentReader:
+   """ file-like view of the next length bytes of stream, md5 as read """
+   def __init__(self,stream,length,lead=b''):
+      self.stream=stream
+      self.remaining=length
+      self.lead=memoryview(lead)
+      self.bytes=0
+      self.md5=hashlib.md5()
+
+   def read(self,size=-1):
+      if self.remaining<=0:
+         return b''
+      if size<0 or size>self.remaining:
+         size=self.remaining
+
+      if self.lead:
+         data=self.lead[:size].tobytes()
+         self.lead=self.lead[size:]
+      else:
+         data=self.stream.read(size)
+
+      self.remaining-=len(data)
+      self.bytes+=len(data)
+      self.md5.update(data)
+      return data
+
+# segment paths of an existing SLO so they can be removed once replaced
+def get_slo_segments(conn,container,swiftname):
+   try:
+      headers=conn.head_object(container,swiftname)
+      if 'x-static-large-object' not in headers:
+         return []
+      headers,body=conn.get_object(container,swiftname,
+         query_string='multipart-manifest=get')
+      return [segment['name'] for segment in json.loads(body.decode())]
+   except ClientException:
+      return []
+
+def delete_segments(conn,segments):
+   for segment in segments:
+      seg_container,seg_obj=segment.lstrip('/').split('/',1)
+      try:
+         conn.delete_object(seg_container,seg_obj)
+      except ClientException as err:
+         sys.stderr.write('***** SEGMENT DELETE ERROR %s: %s *****\n' % 
+            (segment,err))
+
+# upload readable stream as swiftname, segmenting into an SLO as it fills
+def upload_stream_to_swift(stream,swiftname,container,meta):
+   global segment_size,stream_chunk_size,stream_buffer_size,upload_info
+
+   headers=meta_to_headers(meta)
+   headers["X-Object-Meta-Mtime"]="%f" % time.time()
+
+   conn=create_sw_conn()
+   old_segments=get_slo_segments(conn,container,swiftname)
+
+   manifest=None
+   lead=stream.read(stream_buffer_size)
+   if len(lead)<stream_buffer_size:
+      # whole bundle is already in memory, store as a regular object
+      etag=conn.put_object(container,swiftname,lead,headers=headers)
+   else:
+      seg_container=".segments_"+container
+      seg_prefix="%s/slo/%s/stream/%d/" % (swiftname,
+         headers["X-Object-Meta-Mtime"],segment_size)
+      conn.put_container(seg_container)
+
+      manifest=[]
+      while lead:
+         seg_name=seg_prefix+"%08d" % len(manifest)
+         reader=SegmentReader(stream,segment_size,lead)
+         etag=conn.put_object(seg_container,seg_name,reader,
+            chunk_size=stream_chunk_size)
+         if etag!=reader.md5.hexdigest():
+            raise ClientException('Segment %s etag mismatch' % seg_name)
+         manifest.append({"path":"/"+seg_container+"/"+seg_name,
+            "etag":etag,"size_bytes":reader.bytes})
+
+         # a full segment may have been the last one
+         lead=b''
+         if reader.bytes==segment_size:
+            lead=stream.read(stream_chunk_size)
+
+      etag=conn.put_object(container,swiftname,json.dumps(manifest),
+         headers=headers,query_string='multipart-manifest=put')
+
+   upload_info=(sum(segment["size_bytes"] for segment in manifest) 
+      if manifest else len(lead),(etag or '').strip('"') or None)
+   delete_segments(conn,old_segments)
+   conn.close()
+
+   return etag
+
 def archive_tar_file(src_path,file_list,container,tmp_dir,pre_path,meta,
-   recurse=False):
+   recurse=False,stream=False):
    global tar_suffix
+   global engine,expand
+
+   if expand:
+      return expand_to_swift(src_path,file_list,container,pre_path,recurse)
+
+   if engine=="python":
+      return archive_python_file(src_path,file_list,container,tmp_dir,
+         pre_path,meta,recurse,stream)
 
    # archive_name is name for archived object
    archive_name=pre_path+tar_suffix
+   codec=bundle_codec(src_path,file_list,recurse)
+   meta=meta+["-HX-Object-Meta-Codec:"+codec]
+
+   if stream:
+      # pipe tar output straight into swift, no local copy
+      proc,tar_params=open_tar_stream(src_path,file_list,recurse,codec)
+      uploaded=False
+      try:
+         upload_stream_to_swift(proc.stdout,archive_name,container,meta)
+         uploaded=True
+      except (ClientException, RequestException, socket.error) as err:
+         sys.stderr.write('***** UPLOAD ERROR %s: %s *****\n' % 
+            (archive_name,err))
+         proc.kill()
+      proc.stdout.close()
+      ret=proc.wait()
+      if ret>0:
+         sys.stderr.write('***** TAR ERROR %s, command: %s *****\n' % 
+            (ret,tar_params))
+      return uploaded and ret==0
+
    # temp_archive_name is name of local tar file
    temp_archive_name=unique_id()+os.path.basename(archive_name)
    if tmp_dir:
       temp_archive_name=os.path.join(tmp_dir,temp_archive_name)
   
    # Create local tar file 
-   create_tar_file(temp_archive_name,src_path,file_list,recurse)
-
-   # Upload tar file to container as 'archive_name' 
-   upload_file_to_swift(temp_archive_name,archive_name,container,meta)
+   reserved=reserve_temp(tar_footprint(src_path,file_list,recurse))
+   try:
+      tarred=create_tar_file(temp_archive_name,src_path,file_list,recurse,
+         codec)
+
+      # Upload tar file to container as 'archive_name' 
+      uploaded=upload_file_to_swift(temp_archive_name,archive_name,container,
+         meta)
+   finally:
+      # Delete local tar file, the space is given back even if that failed
+      if os.path.exists(temp_archive_name):
+         os.unlink(temp_archive_name)
+      release_temp(reserved)
+
+   return tarred and uploaded
+
+# PUT a tar stream to the bulk middleware, which creates an object under
+# upload_path for every file in it, returns the middleware's json report
+def bulk_extract(conn,container,upload_path,stream,archive_format):
+   global stream_chunk_size
+
+   url,token=conn.url,conn.token
+   if not token:
+      url,token=conn.get_auth()
+   parsed,http=conn.http_connection(url)
+
+   path="%s/%s" % (parsed.path.rstrip('/'),quote(container))
+   if upload_path.strip('/'):
+      path+="/"+quote(upload_path.strip('/'))
+   http.request("PUT",path+"?extract-archive="+archive_format,
+      data=iter(lambda:stream.read(stream_chunk_size),b''),
+      headers={"X-Auth-Token":token,"Accept":"application/json"})
+   resp=http.getresponse()
+   body=resp.read()
+   if resp.status<200 or resp.status>=300:
+      raise ClientException("Bulk extract failed",http_status=resp.status,
+         http_reason=resp.reason)
+
+   # the middleware pads with whitespace while it works
+   return json.loads(body.decode().strip() or "{}")
+
+# members of names an extract-archive error report says were not created
+def failed_members(names,errors):
+   paths=[unquote(path) for path,status in errors]
+   return [name for name in names 
+      if any(path.endswith('/'+os.path.normpath(name)) for path in paths)]
+
+# expand mode: have swift unpack the directory into one object per file
+# under upload_path, members that fail are sent again in a smaller tar
+def expand_to_swift(src_path,file_list,container,upload_path,recurse=False):
+   global engine,expand_formats,expand_retries
+
+   codec=bundle_codec(src_path,file_list,recurse)
+   if codec not in expand_formats:
+      codec="gzip"
+   names=list(file_list)
+
+   conn=create_sw_conn()
+   expanded=False
+   for attempt in range(expand_retries+1):
+      proc=None
+      if engine=="python":
+         r,w=os.pipe()
+         stream=os.fdopen(r,'rb')
+         writer=threading.Thread(target=write_tar_to,
+            args=(os.fdopen(w,'wb'),src_path,names,recurse,False,
+               codec!="none",[]))
+         writer.start()
+      else:
+         proc,tar_params=open_tar_stream(src_path,names,recurse,codec)
+         stream=proc.stdout
 
-   # Delete local tar file
-   os.unlink(temp_archive_name)
+      try:
+         report=bulk_extract(conn,container,upload_path,stream,
+            expand_formats[codec])
+      except (ClientException, RequestException, socket.error) as err:
+         sys.stderr.write('***** EXPAND ERROR %s: %s *****\n' % 
+            (src_path,err))
+         report={"Response Status":"","Errors":[]}
+      stream.close()
+      if proc:
+         proc.wait()
+      else:
+         writer.join()
+
+      errors=report.get("Errors") or []
+      if report.get("Response Status","").startswith("2") and not errors:
+         expanded=True
+         break
+
+      # retry only what failed, or everything if the whole tar was refused
+      for path,status in errors:
+         sys.stderr.write('***** EXPAND ERROR %s: %s *****\n' % 
+            (unquote(path),status))
+      if errors:
+         if recurse:
+            names=tar_member_names(src_path,names,True)
+            recurse=False
+         names=failed_members(names,errors)
+         if not names:
+            break
+
+   conn.close()
+   return expanded
 
 def is_child_or_sib(dir_name,last_dir):
    dname=os.path.dirname(dir_name) 
    return (dname==last_dir or dname==os.path.dirname(last_dir))
 
-# param order: [src_path,file_list,container,tmp_dir,pre_path,meta]
-def archive_worker(item):
-   archive_tar_file(*item)
+# fingerprint of the names, sizes and mtimes of the files a bundle holds
+def dir_fingerprint(src_path,file_list,recurse=False):
+   files=sorted(file_list)
+   if recurse:
+      files=[]
+      for root,dirs,names in walk(src_path):
+         dirs.sort()
+         rel=os.path.relpath(root,src_path)
+         files+=[os.path.normpath(os.path.join(rel,name)) 
+            for name in sorted(names+dir_links(root,dirs))]
+
+   md5=hashlib.md5()
+   for name in files:
+      try:
+         st=os.lstat(os.path.join(src_path,name))
+      except OSError:
+         continue
+      md5.update(os.fsencode("%s\0%d\0%d\n" % 
+         (name,st.st_size,st.st_mtime_ns)))
+
+   return md5.hexdigest()
+
+# bytes held by the files of a directory bundle
+def dir_size(src_path,file_list):
+   size=0
+   for file in file_list:
+      try:
+         size+=os.lstat(os.path.join(src_path,file)).st_size
+      except OSError:
+         pass
+
+   return size
+
+# upper bound of a bundle's temp file, the uncompressed tar size
+def tar_footprint(src_path,file_list,recurse=False):
+   size=1024
+   for name in tar_member_names(src_path,file_list,recurse):
+      try:
+         size+=512+(os.lstat(os.path.join(src_path,name)).st_size+511)//512*512
+      except OSError:
+         pass
+
+   return size
+
+# small json bookkeeping objects (catalog, pack index) kept under the prefix
+def get_json_object(container,name):
+   conn=create_sw_conn()
+   try:
+      headers,body=conn.get_object(container,name)
+      content=json.loads(body.decode())
+   except ClientException:
+      content={}
+   conn.close()
+
+   return content
+
+def put_json_object(container,name,content):
+   conn=create_sw_conn()
+   try:
+      conn.put_object(container,name,json.dumps(content,sort_keys=True),
+         content_type='application/json')
+   except (ClientException, RequestException, socket.error) as err:
+      sys.stderr.write('***** JSON OBJECT ERROR %s: %s *****\n' % (name,err))
+   conn.close()
+
+# delete pack bundles and their json objects the pack index no longer
+# points to, segments of a streamed pack go with it
+def delete_stale_packs(container,prefix,index):
+   global pack_id,tar_suffix,members_suffix,digests_suffix
+
+   referenced=set(index.values())
+   pack_path=os.path.join(prefix,pack_id)+'/'
+   conn=create_sw_conn()
+   try:
+      headers,objs=conn.get_container(container,prefix=pack_path,
+         full_listing=True)
+      for obj in objs:
+         name=obj['name']
+         for suffix in (tar_suffix,members_suffix,digests_suffix):
+            if name.endswith(suffix):
+               if name[:-len(suffix)]+tar_suffix not in referenced:
+                  conn.delete_object(container,name,
+                     query_string='multipart-manifest=delete')
+               break
+   except (ClientException, RequestException, socket.error) as err:
+      sys.stderr.write('***** PACK CLEANUP ERROR %s *****\n' % err)
+   conn.close()
+
+# entries of bundles uploaded without their etag are written again with the
+# etag of their object, taken from one listing rather than by reading every
+# temp file back, the last line of a bundle is the one a resume uses
+def journal_etags(container,prefix,journal,entries):
+   conn=create_sw_conn()
+   try:
+      headers,objs=conn.get_container(container,prefix=prefix,
+         full_listing=True)
+      for obj in objs:
+         if obj['name'] in entries:
+            entry=entries[obj['name']]
+            entry["etag"]=obj['hash']
+            journal.write(entry)
+   except (ClientException, RequestException, socket.error) as err:
+      sys.stderr.write('***** JOURNAL ERROR etags not listed: %s *****\n' % 
+         err)
+   conn.close()
+
+# default journal, one per container, prefix and direction
+def journal_file(tmp_dir,container,prefix,extract=False):
+   global journal_id
+
+   name="%s-%s-%s-%s" % (journal_id,"extract" if extract else "archive",
+      container,prefix.strip('/').replace('/','_'))
+   return os.path.join(tmp_dir or os.path.expanduser("~"),name)
+
+class Journal:
+   """ local record of finished bundles, one json object per line """
+   def __init__(self,path,resume=False):
+      self.path=path
+      self.entries={}
+      if resume and os.path.exists(path):
+         with open(path) as f:
+            for line in f:
+               try:
+                  entry=json.loads(line)
+               except ValueError:
+                  # line cut short when the last run stopped
+                  continue
+               self.entries[entry["name"]]=entry
+      # appended to, runs sharing a journal don't wipe each other's lines
+      self.file=open(path,'a')
+      self.lock=threading.Lock()
+
+   # entry of a finished item, None if missing or failed
+   def done(self,name):
+      entry=self.entries.get(name)
+      if entry and entry["status"]!="failed":
+         return entry
+
+      return None
+
+   def write(self,entry):
+      with self.lock:
+         self.file.write(json.dumps(entry,sort_keys=True)+'\n')
+         self.file.flush()
+
+   def close(self):
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.file.close()
+
+# split large files out of a directory's file list, returns the remaining
+# files with their total size and the large files with their sizes
+def split_large_files(src_path,file_list,split_size):
+   small=[]
+   small_bytes=0
+   large=[]
+   for file in file_list:
+      try:
+         st=os.lstat(os.path.join(src_path,file))
+      except OSError:
+         small.append(file)
+         continue
+      if split_size and stat.S_ISREG(st.st_mode) and st.st_size>=split_size:
+         large.append([file,st.st_size])
+      else:
+         small.append(file)
+         small_bytes+=st.st_size
+
+   return small,small_bytes,large
+
+# param order: [src_path,file_list,container,tmp_dir,pre_path,meta,recurse,
+#    stream]
+# in incremental mode status is skipped, refreshed, added or failed
+# with journal the size of the uploaded bundle and the etag of a streamed
+# one are kept from the upload; cpu is the seconds spent in the worker and in its tar and
+# compressors
+def archive_worker(item,incremental=False,last_fp=None,size=0,journal=False):
+   global tar_suffix
+   global cpu_budget,compress_threads,upload_info,track_uploads
+
+   result={"name":item[4]+tar_suffix,"fingerprint":None,"status":"added",
+      "pid":os.getpid(),"start":time.time(),"bytes":size,"etag":None}
+   cpu_start=cpu_times()
+   if cpu_budget:
+      compress_threads=cpu_budget.start()
+
+   fingerprint=None
+   if incremental:
+      fingerprint=dir_fingerprint(item[0],item[1],item[6])
+      result["fingerprint"]=last_fp
+
+   upload_info=None
+   track_uploads=journal
+   if incremental and fingerprint==last_fp:
+      result["status"]="skipped"
+   elif not archive_tar_file(*item):
+      result["status"]="failed"
+   else:
+      result["fingerprint"]=fingerprint
+      if last_fp:
+         result["status"]="refreshed"
+      if journal and upload_info:
+         result["object_bytes"],result["etag"]=upload_info
+
+   if cpu_budget:
+      cpu_budget.finish(compress_threads)
+   result["cpu"]=[end-start for end,start in zip(cpu_times(),cpu_start)]
+   result["end"]=time.time()
+   return result
+
+def print_utilization(usage,wall):
+   wall=max(wall,1e-6)
+   for pid,(jobs,busy,size) in sorted(usage.items()):
+      print_flush("worker %d: %d jobs, %d bytes, busy %.1fs of %.1fs (%.0f%%)" % 
+         (pid,jobs,size,busy,wall,100*busy/wall))
 
 # if par==1 then multiprocessing Pool won't actually be used (debug mostly)
+# with schedule jobs wait in a queue ordered by size while the tree is walked
+# and the largest one waiting is started whenever a worker is free, files
+# of split_size or more are archived as jobs of their own
+# bundles are recorded in journal_path as they finish, with resume those
+# whose directory is unchanged since they were journaled are skipped
 def archive_to_swift(local_dir,container,no_hidden,tmp_dir,prefix,par,subtree,
-   meta):
+   meta,stream=False,incremental=False,pack_size=0,schedule=False,
+   split_size=0,journal_path=None,resume=False):
+   global tar_suffix,catalog_id,pack_id,index_id,split_id
+   global expand
+
    last_dir=""
    special=['.git']
+   started=time.time()
 
    # Now updating object not container metadata
    #sw_post(container,*meta)
    sw_post(container)
 
+   catalog={}
+   if incremental:
+      catalog=get_json_object(container,os.path.join(prefix,catalog_id))
+   counts={"skipped":0,"refreshed":0,"added":0,"failed":0}
+   # per worker pid: jobs, busy seconds, bytes
+   usage={}
+   # cpu seconds in workers and in their tar and compressor processes
+   cpu=[0.0,0.0]
+
+   journal=None
+   if journal_path:
+      journal=Journal(journal_path,resume)
+   check=incremental or bool(journal)
+
+   # fingerprint a bundle is compared against, the journal's is newer
+   def last_fingerprint(name):
+      if resume and journal.done(name):
+         return journal.done(name)["fingerprint"]
+      return catalog.get(name)
+
+   # journal entries of bundles uploaded from temp files, their etag is
+   # filled in from the container listing once the run is done
+   unlisted={}
+
+   # runs in parent, from pool result thread when par>1
+   def record(result):
+      counts[result["status"]]+=1
+      if result["name"] in packed and result["status"]!="failed":
+         for rel_dir in packed[result["name"]]:
+            index[rel_dir]=result["name"]
+      if result["fingerprint"]:
+         catalog[result["name"]]=result["fingerprint"]
+      if journal and result["status"]!="skipped":
+         entry={"name":result["name"],"status":result["status"],
+            "fingerprint":result["fingerprint"],
+            "bytes":result.get("object_bytes"),"etag":result["etag"]}
+         journal.write(entry)
+         if result["status"]!="failed" and not result["etag"]:
+            unlisted[result["name"]]=entry
+      worker=usage.setdefault(result["pid"],[0,0.0,0])
+      worker[0]+=1
+      worker[1]+=result["end"]-result["start"]
+      worker[2]+=result["bytes"]
+      cpu[0]+=result["cpu"][0]
+      cpu[1]+=result["cpu"][1]
+
    archive_pool=multiprocessing.Pool(par)
 
+   # bound jobs waiting in the pool so the walk can't run far ahead, with
+   # schedule only running jobs are in the pool so the next one is picked
+   # when a worker frees up
+   inflight=threading.Semaphore(par if schedule else par*4)
+
+   def done(result):
+      inflight.release()
+      record(result)
+
+   def failed(err):
+      inflight.release()
+      sys.stderr.write('***** ARCHIVE ERROR %s *****\n' % err)
+
+   # acquired if the caller already holds a slot of inflight
+   def submit(p,size,acquired=False):
+      last_fp=last_fingerprint(p[4]+tar_suffix)
+      if par>1:
+         if not acquired:
+            inflight.acquire()
+         archive_pool.apply_async(archive_worker,
+            [p,check,last_fp,size,bool(journal)],
+            callback=done,error_callback=failed)
+      else:
+         record(archive_worker(p,check,last_fp,size,bool(journal)))
+         if acquired:
+            inflight.release()
+
+   # largest first so no big job is left to start last, None ends the walk
+   jobs=queue.PriorityQueue()
+   order=itertools.count()
+
+   def feed():
+      while True:
+         inflight.acquire()
+         size,seq,p=jobs.get()
+         if p is None:
+            inflight.release()
+            return
+         submit(p,-size,True)
+
+   if schedule:
+      feeder=threading.Thread(target=feed)
+      feeder.start()
+
+   def dispatch(p,size=0):
+      if schedule:
+         jobs.put((-size,next(order),p))
+      else:
+         submit(p,size)
+
+   # pack mode: directories smaller than pack_size are collected during the
+   # walk and archived together in path order, relative to local_dir; a
+   # pack is named by the directories it holds so a run never overwrites a
+   # pack holding directories it didn't walk, the index moves to a pack
+   # once it is uploaded
+   index={}
+   if pack_size:
+      index=get_json_object(container,os.path.join(prefix,index_id))
+   small=[]
+   packed={}
+
+   def dispatch_pack(pack,pack_bytes):
+      pack_name=os.path.join(prefix,pack_id,hashlib.md5("\n".join(
+         rel_dir for rel_dir,file_list in pack).encode()).hexdigest())
+      packed[pack_name+tar_suffix]=[rel_dir for rel_dir,file_list in pack]
+      pack_members=[]
+      for rel_dir,file_list in pack:
+         if rel_dir!=".":
+            pack_members.append(rel_dir)
+         pack_members.extend(os.path.normpath(os.path.join(rel_dir,file))
+            for file in file_list)
+      dispatch([local_dir,pack_members,container,tmp_dir,pack_name,
+         meta,False,stream],pack_bytes)
+
    for dir_name, subdir_list, file_list in mywalk(local_dir):
       rel_path=os.path.relpath(dir_name,local_dir)
       if (not (no_hidden and is_hidden_dir(rel_path))):
+         # large files go in bundles of their own next to the directory's
+         split_path=rel_path
+         if rel_path==".":
+            split_path=""
+
          # if files in root directory use basename of root
          if rel_path==".":
             rel_path=os.path.basename(dir_name)+root_id
@@ -272,25 +1383,89 @@ def archive_to_swift(local_dir,container,no_hidden,tmp_dir,prefix,par,subtree,
          if dir_t[-1] in special:
             # special directory - archive recursively from here
             #print("\tlast is in special!")
-            archive_worker([dir_name,file_list,container,tmp_dir,
-               os.path.join(prefix,rel_path),meta,True])
+            p=[dir_name,file_list,container,tmp_dir,
+               os.path.join(prefix,rel_path),meta,True,stream]
+            record(archive_worker(p,check,last_fingerprint(p[4]+tar_suffix),
+               0,bool(journal)))
          elif any(item in special for item in dir_t):
             # assumed child of special path, ignore as archived from special
             #print("\tskipping child of special!")
             pass
          elif (not subtree) or (is_subtree(subtree,dir_name)):
-            p=[dir_name,file_list,container,tmp_dir,
-               os.path.join(prefix,rel_path),meta]
-            if par>1:
-               archive_pool.apply_async(archive_worker,[p])
+            size=0
+            if split_size or schedule or pack_size:
+               file_list,size,large=split_large_files(dir_name,file_list,
+                  split_size)
+               for file,file_size in large:
+                  dispatch([dir_name,[file],container,tmp_dir,
+                     os.path.join(prefix,split_path,file+split_id),meta,False,
+                     stream],file_size)
+
+            if size<pack_size:
+               small.append([os.path.relpath(dir_name,local_dir),file_list,
+                  size])
             else:
-               archive_worker(p)
+               index.pop(os.path.relpath(dir_name,local_dir),None)
+               if expand:
+                  rel_path=split_path
+               dispatch([dir_name,file_list,container,tmp_dir,
+                  os.path.join(prefix,rel_path),meta,False,stream],size)
 
          last_dir=dir_name
 
+   # walk order isn't stable, with --walkers it's random
+   small.sort(key=lambda item:item[0])
+   pack=[]
+   pack_bytes=0
+   for rel_dir,file_list,size in small:
+      pack.append([rel_dir,file_list])
+      pack_bytes+=size
+      if pack_bytes>=pack_size:
+         dispatch_pack(pack,pack_bytes)
+         pack,pack_bytes=[],0
+   if pack:
+      dispatch_pack(pack,pack_bytes)
+
+   if schedule:
+      jobs.put((float("inf"),next(order),None))
+      feeder.join()
+
    archive_pool.close()
    archive_pool.join()
 
+   if pack_size:
+      put_json_object(container,os.path.join(prefix,index_id),index)
+      delete_stale_packs(container,prefix,index)
+
+   if incremental:
+      put_json_object(container,os.path.join(prefix,catalog_id),catalog)
+
+   if incremental or resume:
+      print_flush("%s: %d skipped, %d refreshed, %d added, %d failed" % 
+         ("incremental" if incremental else "resume",counts["skipped"],
+            counts["refreshed"],counts["added"],counts["failed"]))
+
+   if unlisted:
+      journal_etags(container,prefix,journal,unlisted)
+
+   if journal:
+      journal.close()
+
+   if schedule:
+      print_utilization(usage,time.time()-started)
+
+   print_cpu([("workers",cpu[0]),("tar+compress",cpu[1])],
+      time.time()-started,cpu_budget.cpus if cpu_budget else os.cpu_count())
+
+# directory a split file bundle extracts into, None if not a split bundle
+def split_dir(rel_name):
+   global tar_suffix,split_id
+
+   if rel_name.endswith(split_id+tar_suffix):
+      return os.path.dirname(rel_name)
+
+   return None
+
 # parse name into directory tree
 def create_local_path(local_dir,archive_name):
    global tar_suffix
@@ -320,82 +1495,827 @@ def create_sw_conn():
    print("Error: Swift environment not configured!")
    sys.exit()
 
-def extract_tar_file(tarfile,termpath):
-   global haz_pigz
-
-   tar_params=["tar","xvf",tarfile,"--directory="+termpath,
+def tar_extract_params(filename,termpath,excludes=None):
+   tar_params=["tar","xvf",filename,"--directory="+termpath,
         '--same-permissions', '--delay-directory-restore'] 
         # --same-owner is used when user=root
-   if haz_pigz:
-      tar_params+=["--use-compress-program=pigz"]
+
+   # directories (and everything below them) to leave out of a pack
+   if excludes:
+      tar_params+=["--anchored","--no-wildcards"]
+      tar_params+=["--exclude="+exclude for exclude in excludes]
+
+   return tar_params
+
+# tar params for decompressing a bundle starting with lead
+def tar_decompress_params(lead):
+   global haz_pigz
+
+   codec=detect_codec(lead)
+   if codec=="gzip" and haz_pigz:
+      codec="pigz"
+
+   return tar_codec_params(codec)
+
+def extract_tar_file(tarfile,termpath,excludes=None):
+   with open(tarfile,'rb') as f:
+      lead=f.read(8)
+
+   tar_params=tar_extract_params(tarfile,termpath,excludes)+\
+      tar_decompress_params(lead)
 
    ret=subprocess.call(tar_params)
    if ret > 0:
       sys.stderr.write('***** TAR ERROR %s, command: %s *****\n' % 
          (ret,tar_params))
-   
-def retrieve_tar_file(tmp_dir,container,obj_name,local_dir,prefix):
-   global tar_suffix
-   global root_id
 
-   # download tar file and extract into terminal directory
-   temp_file=unique_id()+tar_suffix
-   if tmp_dir:
-      temp_file=os.path.join(tmp_dir,temp_file)
+   return ret==0
+
+# feed object body into tar as it arrives, no local copy
+def extract_tar_stream(container,obj_name,termpath,excludes=None):
+   global stream_chunk_size
+
+   conn=create_sw_conn()
+   try:
+      headers,body=conn.get_object(container,obj_name,
+         resp_chunk_size=stream_chunk_size)
+      chunks=iter(body)
+
+      # tar can't detect compression on a pipe so look at the leading bytes
+      lead=b''
+      for chunk in chunks:
+         lead+=chunk
+         if len(lead)>=8:
+            break
+   except (ClientException, RequestException, socket.error) as err:
+      sys.stderr.write('***** DOWNLOAD ERROR %s: %s *****\n' % 
+         (obj_name,err))
+      conn.close()
+      return False
+
+   tar_params=tar_extract_params("-",termpath,excludes)+\
+      tar_decompress_params(lead)
+   proc=subprocess.Popen(tar_params,stdin=subprocess.PIPE)
+   ok=True
+   try:
+      proc.stdin.write(lead)
+      for chunk in chunks:
+         proc.stdin.write(chunk)
+   except BrokenPipeError:
+      pass
+   except (ClientException, RequestException, socket.error) as err:
+      sys.stderr.write('***** DOWNLOAD ERROR %s: %s *****\n' % 
+         (obj_name,err))
+      proc.kill()
+      ok=False
+
+   try:
+      proc.stdin.close()
+   except BrokenPipeError:
+      pass
+   ret=proc.wait()
+   if ret > 0:
+      sys.stderr.write('***** TAR ERROR %s, command: %s *****\n' % 
+         (ret,tar_params))
+
+   conn.close()
+   return ok and ret==0
+
+class ChunkReader:
+   """ file-like over an iterator of byte chunks """
+   def __init__(self,chunks):
+      self.chunks=iter(chunks)
+      self.tail=b''
+
+   def read(self,size=-1):
+      data=bytearray(self.tail)
+      while size<0 or len(data)<size:
+         chunk=next(self.chunks,None)
+         if chunk is None:
+            break
+         data+=chunk
+
+      if size<0:
+         size=len(data)
+      self.tail=bytes(data[size:])
+      return bytes(data[:size])
+
+# members are extracted as GNU tar does: a leading / is stripped, members
+# that would end up outside the target directory are skipped and modes are
+# kept as with --same-permissions; None if member is skipped
+def tar_member_filter(member,path):
+   member.name=member.name.lstrip('/') or '.'
+   names=[member.name]
+   if member.islnk():
+      member.linkname=member.linkname.lstrip('/')
+      names.append(member.linkname)
+
+   target=os.path.realpath(path)
+   for name in names:
+      parent=os.path.realpath(os.path.join(path,os.path.dirname(name)))
+      if '..' in name.split('/') or \
+         os.path.commonpath([parent,target])!=target:
+         sys.stderr.write('***** TAR WARNING %s: outside of the target '
+            'directory, skipped *****\n' % name)
+         return None
+
+   return member
+
+# pythons without extraction filters get the filter applied by the caller
+if hasattr(tarfile,"fully_trusted_filter"):
+   tar_extract_args={"filter":tar_member_filter}
+else:
+   tar_extract_args={}
+
+def filtered_member(member,path):
+   if tar_extract_args:
+      return member
+   return tar_member_filter(member,path)
 
-   sw_download("--output="+temp_file,container,obj_name)
+def is_excluded(name,excludes):
+   name=os.path.normpath(name)
+   return any(name==exclude or name.startswith(exclude+'/') 
+      for exclude in excludes)
 
-   # strip prefix and if next char is /, strip it too
+# python engine version of extract_tar_file, fileobj may be a stream; the
+# bundle is decompressed here as tarfile would stop after the first gzip
+# member of a bundle written with --index-members
+def extract_python(fileobj,termpath,excludes=None):
+   global verbose,stream_chunk_size
+
+   chunks=decompress_chunks(iter(lambda:fileobj.read(stream_chunk_size),b''))
+   try:
+      with tarfile.open(fileobj=ChunkReader(chunks),mode='r|') as tar:
+         def members():
+            for info in tar:
+               if excludes and is_excluded(info.name,excludes):
+                  continue
+               if not filtered_member(info,termpath):
+                  continue
+               if verbose:
+                  print_flush(info.name)
+               yield info
+
+         # directory attributes are set last, as --delay-directory-restore
+         tar.extractall(termpath,members=members(),**tar_extract_args)
+
+      # the rest of the stream, so a failing decompressor is noticed
+      for data in chunks:
+         pass
+   # KeyError is a hard link to a member the stream doesn't have
+   except (zlib.error, EOFError, lzma.LZMAError, KeyError) as err:
+      raise tarfile.TarError(str(err))
+
+def extract_python_stream(container,obj_name,termpath,excludes=None):
+   global stream_chunk_size
+
+   conn=create_sw_conn()
+   ok=True
+   try:
+      headers,body=conn.get_object(container,obj_name,
+         resp_chunk_size=stream_chunk_size)
+      extract_python(ChunkReader(body),termpath,excludes)
+   except (ClientException, RequestException, socket.error, 
+      tarfile.TarError) as err:
+      sys.stderr.write('***** EXTRACT ERROR %s: %s *****\n' % 
+         (obj_name,err))
+      ok=False
+   conn.close()
+
+   return ok
+
+# strip prefix and if next char is /, strip it too
+def strip_prefix(obj_name,prefix):
    if prefix and obj_name.startswith(prefix):
       obj_name=obj_name[len(prefix):] 
       if obj_name[0]=='/':
          obj_name=obj_name[1:]
+
+   return obj_name
+
+# excludes is None unless obj_name is a pack bundle, True if extracted
+# size is the object's size, reserved from the temp budget while downloaded
+def retrieve_tar_file(tmp_dir,container,obj_name,local_dir,prefix,
+   stream=False,excludes=None,size=0):
+   global tar_suffix
+   global root_id
+   global engine
+
+   rel_name=strip_prefix(obj_name,prefix)
    
-   # if bundle, extract using tar embedded paths
-   if obj_name.endswith(root_id+tar_suffix):
+   # if bundle or pack, extract using tar embedded paths
+   if excludes is not None or rel_name.endswith(root_id+tar_suffix):
+      term_path=local_dir
+   elif split_dir(rel_name) is not None:
       term_path=local_dir
+      if split_dir(rel_name):
+         term_path=create_local_path(local_dir,split_dir(rel_name))
    else:
-      term_path=create_local_path(local_dir,obj_name)
+      term_path=create_local_path(local_dir,rel_name)
 
-   extract_tar_file(temp_file,term_path)
+   if stream:
+      if engine=="python":
+         return extract_python_stream(container,obj_name,term_path,excludes)
+      return extract_tar_stream(container,obj_name,term_path,excludes)
 
-   os.unlink(temp_file)
+   # download tar file and extract into terminal directory
+   temp_file=unique_id()+tar_suffix
+   if tmp_dir:
+      temp_file=os.path.join(tmp_dir,temp_file)
 
+   reserved=reserve_temp(size)
+   try:
+      ok=sw_download("--output="+temp_file,container,obj_name)
+
+      if ok and engine=="python":
+         try:
+            with open(temp_file,'rb') as f:
+               extract_python(f,term_path,excludes)
+         except (OSError, tarfile.TarError) as err:
+            sys.stderr.write('***** EXTRACT ERROR %s: %s *****\n' % 
+               (obj_name,err))
+            ok=False
+      elif ok:
+         ok=extract_tar_file(temp_file,term_path,excludes)
+   finally:
+      if os.path.exists(temp_file):
+         os.unlink(temp_file)
+      release_temp(reserved)
+
+   return ok
+
+# returns [obj_name,extracted,cpu seconds in worker and tar/decompressor]
 def extract_worker(item):
-   retrieve_tar_file(*item)
+   cpu_start=cpu_times()
+   ok=retrieve_tar_file(*item)
+   return [item[2],ok,[end-start for end,start in zip(cpu_times(),cpu_start)]]
+
+class GunzipReader:
+   """ file-like decompressing a stream of gzip chunks """
+   def __init__(self,chunks):
+      self.chunks=iter(chunks)
+      self.decompressor=zlib.decompressobj(31)
+      self.tail=b''
+
+   def read(self,size=-1):
+      data=bytearray()
+      while size<0 or len(data)<size:
+         if not self.tail:
+            self.tail=next(self.chunks,b'')
+            if not self.tail:
+               break
+         data+=self.decompressor.decompress(self.tail,
+            size-len(data) if size>=0 else 0)
+         self.tail=self.decompressor.unconsumed_tail
+         if self.decompressor.eof:
+            # concatenated gzip members
+            self.tail=self.decompressor.unused_data
+            self.decompressor=zlib.decompressobj(31)
+
+      return bytes(data)
+
+class Channel:
+   """ bounded queue of chunks of one bundle between two pipeline stages """
+   def __init__(self):
+      self.chunks=queue.Queue(pipeline_queue_size)
+      self.abandoned=False
+      self.put_wait=0.0
+      self.get_wait=0.0
+
+   # None ends the bundle and an exception is raised at the consumer, False
+   # once the consumer has given up
+   def put(self,data):
+      start=time.time()
+      while not self.abandoned:
+         try:
+            self.chunks.put(data,timeout=1)
+            break
+         except queue.Full:
+            pass
+      self.put_wait+=time.time()-start
+      return not self.abandoned
+
+   def abandon(self):
+      self.abandoned=True
+
+   def __iter__(self):
+      while True:
+         start=time.time()
+         data=self.chunks.get()
+         self.get_wait+=time.time()-start
+         if data is None:
+            return
+         if isinstance(data,Exception):
+            raise data
+         yield data
+
+def feed_chunks(pipe,chunks):
+   try:
+      for chunk in chunks:
+         pipe.write(chunk)
+   except OSError:
+      pass
+   finally:
+      pipe.close()
+
+# decompressed data of a bundle's chunks, by the bundle's leading bytes
+def decompress_chunks(chunks):
+   global codec_commands,stream_chunk_size
+
+   chunks=iter(chunks)
+   lead=b''
+   for chunk in chunks:
+      lead+=chunk
+      if len(lead)>=8:
+         break
+   chunks=itertools.chain([lead],chunks)
+   codec=detect_codec(lead)
+
+   if codec=="gzip":
+      reader=GunzipReader(chunks)
+      yield from iter(lambda:reader.read(stream_chunk_size),b'')
+   elif codec in ("bzip2","xz"):
+      decompressor=bz2.BZ2Decompressor() if codec=="bzip2" else \
+         lzma.LZMADecompressor()
+      for chunk in chunks:
+         yield decompressor.decompress(chunk)
+   elif codec in ("zstd","lz4"):
+      proc=subprocess.Popen(codec_commands[codec]+["-d"],
+         stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+      threading.Thread(target=feed_chunks,args=(proc.stdin,chunks),
+         daemon=True).start()
+      try:
+         yield from iter(lambda:proc.stdout.read(stream_chunk_size),b'')
+      finally:
+         proc.stdout.close()
+         if proc.wait()>0:
+            raise OSError('%s exited with %d' % 
+               (codec_commands[codec][0],proc.returncode))
+   else:
+      yield from chunks
+
+class ExtractPipeline:
+   """ fetch, decompress and write stages of extract_to_local, each with its
+      own threads and bounded queues, bundles flow through all at once """
+   def __init__(self,container,local_dir,prefix,threads,record):
+      self.container=container
+      self.local_dir=local_dir
+      self.prefix=prefix
+      self.record=record
+      self.lock=threading.Lock()
+      self.started=time.time()
+      # per stage: threads, bytes, busy seconds
+      self.stats=dict((stage,[count,0,0.0]) for stage,count in 
+         zip(("fetch","decompress","write"),threads))
+      self.queues=[queue.Queue(count) for count in threads]
+      self.threads=[[threading.Thread(target=work) for n in range(count)]
+         for work,count in zip((self.fetch,self.decompress,self.write),
+            threads)]
+      for stage in self.threads:
+         for thread in stage:
+            thread.start()
+
+   def submit(self,obj_name,excludes):
+      self.queues[0].put([obj_name,excludes])
+
+   # stages are ended in order so no bundle is left behind
+   def finish(self):
+      for stage,work_queue in zip(self.threads,self.queues):
+         for thread in stage:
+            work_queue.put(None)
+         for thread in stage:
+            thread.join()
+
+   def account(self,stage,size,busy):
+      with self.lock:
+         self.stats[stage][1]+=size
+         self.stats[stage][2]+=busy
+
+   def fetch(self):
+      global stream_chunk_size
+
+      conn=create_sw_conn()
+      for item in iter(self.queues[0].get,None):
+         out=Channel()
+         self.queues[1].put([item,out])
+         start=time.time()
+         size=0
+         try:
+            headers,body=conn.get_object(self.container,item[0],
+               resp_chunk_size=stream_chunk_size)
+            for chunk in body:
+               size+=len(chunk)
+               if not out.put(chunk):
+                  break
+            out.put(None)
+         except Exception as err:
+            # anything else would leave the next stage waiting on out
+            out.put(err)
+         self.account("fetch",size,time.time()-start-out.put_wait)
+      conn.close()
+
+   def decompress(self):
+      for item,source in iter(self.queues[1].get,None):
+         out=Channel()
+         self.queues[2].put([item,out])
+         start=time.time()
+         size=0
+         try:
+            for data in decompress_chunks(source):
+               size+=len(data)
+               if not out.put(data):
+                  break
+            out.put(None)
+         except Exception as err:
+            out.put(err)
+         finally:
+            source.abandon()
+         self.account("decompress",size,
+            time.time()-start-source.get_wait-out.put_wait)
+
+   def write(self):
+      for (obj_name,excludes),source in iter(self.queues[2].get,None):
+         start=time.time()
+         size=[0]
+         def counted():
+            for data in source:
+               size[0]+=len(data)
+               yield data
+
+         ok=True
+         try:
+            term_path=bundle_base(self.local_dir,
+               strip_prefix(obj_name,self.prefix))
+            os.makedirs(term_path,exist_ok=True)
+            extract_python(ChunkReader(counted()),term_path,excludes)
+         except Exception as err:
+            sys.stderr.write('***** EXTRACT ERROR %s: %s *****\n' % 
+               (obj_name,err))
+            ok=False
+         finally:
+            source.abandon()
+         self.account("write",size[0],time.time()-start-source.get_wait)
+         with self.lock:
+            self.record([obj_name,ok,[0.0,0.0]])
+
+   # the stage with the highest utilization is the one limiting the run
+   def report(self,listed,list_time):
+      wall=max(time.time()-self.started,1e-6)
+      print_flush("list: %d bundles in %.1fs" % (listed,list_time))
+      busiest=None
+      for stage in ("fetch","decompress","write"):
+         threads,size,busy=self.stats[stage]
+         utilization=busy/(threads*wall)
+         print_flush("%s: %d threads, %d bytes, %.1f MB/s, busy %.0f%%" % 
+            (stage,threads,size,size/wall/1048576,100*utilization))
+         if busiest is None or utilization>busiest[1]:
+            busiest=(stage,utilization)
+      print_flush("limited by %s" % busiest[0])
+
+# restore members matching patterns using ranged reads of their gzip frames,
+# returns the number of members that could not be restored
+def restore_members(container,obj_name,local_dir,prefix,patterns,pack=False):
+   global tar_suffix,root_id,members_suffix,stream_chunk_size
+
+   rel_name=strip_prefix(obj_name,prefix)
+   if pack or rel_name.endswith(root_id+tar_suffix):
+      rel_dir=""
+   elif split_dir(rel_name) is not None:
+      rel_dir=split_dir(rel_name)
+   else:
+      rel_dir=rel_name[:-len(tar_suffix)]
+
+   index=get_json_object(container,obj_name[:-len(tar_suffix)]+members_suffix)
+   if "members" not in index:
+      sys.stderr.write('***** RESTORE ERROR %s: member index not readable '
+         '*****\n' % obj_name)
+      return 1
+   wanted=[member for member in index.get("members",[]) 
+      if not stat.S_ISDIR(member["mode"]) and 
+         any(fnmatch.fnmatch(os.path.join(rel_dir,member["path"]),pattern) 
+            for pattern in patterns)]
+   if not wanted:
+      return 0
+
+   term_path=local_dir
+   if rel_dir:
+      term_path=create_local_path(local_dir,rel_dir)
+
+   errors=0
+   conn=create_sw_conn()
+   for member in wanted:
+      byte_range="bytes=%d-%d" % (member["offset"],
+         member["offset"]+member["length"]-1)
+      try:
+         headers,body=conn.get_object(container,obj_name,
+            headers={"Range":byte_range},resp_chunk_size=stream_chunk_size)
+         if index.get("codec","gzip")=="gzip":
+            reader=GunzipReader(body)
+         else:
+            reader=ChunkReader(body)
+         with tarfile.open(fileobj=reader,mode='r|') as tar:
+            for info in tar:
+               if filtered_member(info,term_path):
+                  tar.extract(info,term_path,**tar_extract_args)
+         print_flush(os.path.join(rel_dir,member["path"]))
+      except (ClientException, RequestException, socket.error, 
+         tarfile.TarError, zlib.error) as err:
+         sys.stderr.write('***** RESTORE ERROR %s in %s: %s *****\n' % 
+            (member["path"],obj_name,err))
+         errors+=1
+   conn.close()
+
+   return errors
+
+# param order: [container,obj_name,local_dir,prefix,patterns,pack]
+# returns [obj_name,members that could not be restored]
+def restore_worker(item):
+   return [item[1],restore_members(*item)]
 
 # if par==1 then multiprocessing Pool won't actually be used (debug mostly)
-def extract_to_local(local_dir,container,no_hidden,tmp_dir,prefix,par):
+# with patterns only matching members of bundles with a member index are
+# restored, bundles without one are reported and skipped
+# extracted bundles are recorded in journal_path, with resume those already
+# extracted with the same etag are skipped
+# with stages [fetch,decompress,write] threads bundles go through an
+# ExtractPipeline instead of the pool
+def extract_to_local(local_dir,container,no_hidden,tmp_dir,prefix,par,
+   stream=False,patterns=None,journal_path=None,resume=False,stages=None):
    global tar_suffix
    global root_id
+   global pack_id,index_id,members_suffix
+
+   journal=None
+   if journal_path and not patterns:
+      journal=Journal(journal_path,resume)
+   counts={"skipped":0,"extracted":0,"failed":0}
+   cpu=[0.0,0.0]
+   started=time.time()
+
+   # directories held by each pack bundle, from the pack index
+   packs={}
+   for rel_dir,pack_name in get_json_object(container,
+      os.path.join(prefix,index_id)).items():
+      packs.setdefault(pack_name,[]).append(rel_dir)
+   pack_path=os.path.join(prefix,pack_id)+'/'
 
    swift_conn=create_sw_conn()
    if swift_conn:
       try: 
          headers,objs=swift_conn.get_container(container,prefix=prefix,
             full_listing=True)
-
-         extract_pool=multiprocessing.Pool(par)
+         list_time=time.time()-started
+
+         names=set(obj['name'] for obj in objs)
+         listed=dict((obj['name'],obj) for obj in objs)
+
+         # runs in parent, from pool result thread when par>1
+         def record(result):
+            obj_name,ok,times=result
+            counts["extracted" if ok else "failed"]+=1
+            cpu[0]+=times[0]
+            cpu[1]+=times[1]
+            if journal:
+               journal.write({"name":obj_name,
+                  "status":"extracted" if ok else "failed",
+                  "bytes":listed[obj_name]['bytes'],
+                  "etag":listed[obj_name]['hash']})
+
+         # a worker that raised, its bundle counts as failed
+         def failed(obj_name,err):
+            sys.stderr.write('***** EXTRACT ERROR %s: %s *****\n' % 
+               (obj_name,err))
+            record([obj_name,False,[0.0,0.0]])
+
+         # members that could not be restored count as failed
+         def restored(result):
+            counts["failed"]+=result[1]
+
+         pipeline=None
+         extract_pool=None
+         if stages and not patterns:
+            pipeline=ExtractPipeline(container,local_dir,prefix,stages,record)
+         else:
+            extract_pool=multiprocessing.Pool(par)
 
          for obj in objs:
             if obj['name'].endswith(tar_suffix):
-               if no_hidden and is_hidden_dir(obj['name']):
+               excludes=None
+               if obj['name'] in packs:
+                  rel_dirs=packs[obj['name']]
+                  excludes=[]
+                  if no_hidden:
+                     excludes=[rel_dir for rel_dir in rel_dirs 
+                        if is_hidden_dir(rel_dir)]
+                     if len(excludes)==len(rel_dirs):
+                        continue
+               elif obj['name'].startswith(pack_path):
+                  # no longer referenced by the index
+                  continue
+               elif split_dir(obj['name']) is not None:
+                  if (no_hidden and split_dir(obj['name']) and 
+                     is_hidden_dir(split_dir(obj['name']))):
+                     continue
+               elif no_hidden and is_hidden_dir(obj['name']):
+                  continue
+
+               if patterns:
+                  if obj['name'][:-len(tar_suffix)]+members_suffix in names:
+                     p=[container,obj['name'],local_dir,prefix,patterns,
+                        excludes is not None]
+                     if par>1:
+                        extract_pool.apply_async(restore_worker,[p],
+                           callback=restored,
+                           error_callback=lambda err,name=obj['name']:
+                              failed(name,err))
+                     else:
+                        try:
+                           restored(restore_worker(p))
+                        except Exception as err:
+                           failed(obj['name'],err)
+                  else:
+                     sys.stderr.write('***** RESTORE WARNING %s: no member '
+                        'index, skipped *****\n' % obj['name'])
+                     counts["skipped"]+=1
+                  continue
+
+               if (resume and journal.done(obj['name']) and 
+                  journal.done(obj['name'])["etag"]==obj['hash']):
+                  counts["skipped"]+=1
                   continue
 
-               # param order: [tmp_dir,container,obj_name,local_dir,prefix]
-               p=[tmp_dir,container,obj['name'],local_dir,prefix]
+               if pipeline:
+                  pipeline.submit(obj['name'],excludes)
+                  continue
+
+               # param order: [tmp_dir,container,obj_name,local_dir,prefix,
+               #    stream,excludes,size]
+               p=[tmp_dir,container,obj['name'],local_dir,prefix,stream,
+                  excludes,obj['bytes']]
                if par>1:
-                  extract_pool.apply_async(extract_worker,[p])
+                  extract_pool.apply_async(extract_worker,[p],callback=record,
+                     error_callback=lambda err,name=obj['name']:
+                        failed(name,err))
                else:
-                  extract_worker(p)
-
-         extract_pool.close()
-         extract_pool.join()
+                  try:
+                     result=extract_worker(p)
+                  except Exception as err:
+                     failed(obj['name'],err)
+                  else:
+                     record(result)
+
+         if extract_pool:
+            extract_pool.close()
+            extract_pool.join()
+         if pipeline:
+            pipeline.finish()
+
+         if patterns:
+            print_flush("restore: %d bundles without member index skipped, "
+               "%d failed" % (counts["skipped"],counts["failed"]))
+         if resume:
+            print_flush("resume: %d skipped, %d extracted, %d failed" % 
+               (counts["skipped"],counts["extracted"],counts["failed"]))
+         if pipeline:
+            pipeline.report(sum(1 for obj in objs 
+               if obj['name'].endswith(tar_suffix)),list_time)
+         elif not patterns:
+            print_cpu([("workers",cpu[0]),("tar+decompress",cpu[1])],
+               time.time()-started,os.cpu_count())
       except ClientException:
          print("Error: cannot access Swift container '%s'!" % container)
 
       swift_conn.close()
 
+   if journal:
+      journal.close()
+
+# directory a bundle's members are relative to, nothing is created
+def bundle_base(local_dir,rel_name):
+   global tar_suffix,root_id,pack_id
+
+   if rel_name.endswith(root_id+tar_suffix) or rel_name.startswith(pack_id+'/'):
+      return local_dir
+   if split_dir(rel_name) is not None:
+      return os.path.join(local_dir,split_dir(rel_name))
+
+   return os.path.join(local_dir,rel_name[:-len(tar_suffix)])
+
+# param order: [path,size,md5], returns [path,status]
+def verify_worker(item):
+   global stream_chunk_size
+
+   path,size,md5=item
+   try:
+      if os.lstat(path).st_size!=size:
+         return [path,"changed"]
+      digest=hashlib.md5()
+      with open(path,'rb') as f:
+         for data in iter(lambda:f.read(stream_chunk_size*16),b''):
+            digest.update(data)
+   except OSError:
+      return [path,"missing"]
+
+   return [path,"ok" if digest.hexdigest()==md5 else "changed"]
+
+# compare local_dir with the member digests of the bundles under prefix,
+# only the digest manifests are downloaded
+def verify_local(local_dir,container,no_hidden,prefix,par):
+   global digests_suffix,tar_suffix
+
+   swift_conn=create_sw_conn()
+   try:
+      headers,objs=swift_conn.get_container(container,prefix=prefix,
+         full_listing=True)
+   except ClientException:
+      print("Error: cannot access Swift container '%s'!" % container)
+      return
+   swift_conn.close()
+
+   def members():
+      for obj in objs:
+         if not obj['name'].endswith(digests_suffix):
+            continue
+         manifest=get_json_object(container,obj['name'])
+         if not manifest:
+            continue
+         base=bundle_base(local_dir,strip_prefix(manifest["bundle"],prefix))
+         for path,(size,md5) in sorted(manifest["members"].items()):
+            rel_path=os.path.relpath(os.path.join(base,path),local_dir)
+            if no_hidden and is_hidden_dir(rel_path):
+               continue
+            yield [os.path.normpath(os.path.join(base,path)),size,md5]
+
+   counts={"ok":0,"changed":0,"missing":0}
+   verify_pool=multiprocessing.Pool(par)
+   for path,status in verify_pool.imap_unordered(verify_worker,members(),64):
+      counts[status]+=1
+      if status!="ok":
+         print_flush("%s: %s" % (status,path))
+   verify_pool.close()
+   verify_pool.join()
+
+   print_flush("verify: %d ok, %d changed, %d missing" % 
+      (counts["ok"],counts["changed"],counts["missing"]))
+
+class CountingWriter:
+   def __init__(self):
+      self.bytes=0
+
+   def write(self,data):
+      self.bytes+=len(data)
+      return len(data)
+
+def bench_tar(src_path,file_list):
+   global stream_chunk_size
+
+   proc,tar_params=open_tar_stream(src_path,file_list,False,
+      bundle_codec(src_path,file_list))
+   size=0
+   for data in iter(lambda:proc.stdout.read(stream_chunk_size),b''):
+      size+=len(data)
+   proc.stdout.close()
+   proc.wait()
+   return size
+
+def bench_python(src_path,file_list):
+   global codec_commands
+
+   codec=bundle_codec(src_path,file_list)
+   out=CountingWriter()
+   if codec in ("gzip","none"):
+      write_tar(out,src_path,file_list,compress=(codec=="gzip"))
+      return out.bytes
+
+   proc=subprocess.Popen(codec_commands[codec],stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE)
+   writer=threading.Thread(target=write_tar_to,
+      args=(proc.stdin,src_path,file_list,False,False,False,[]))
+   writer.start()
+   for data in iter(lambda:proc.stdout.read(stream_chunk_size),b''):
+      out.write(data)
+   writer.join()
+   proc.wait()
+   return out.bytes
+
+# time both engines building every bundle of local_dir, nothing is uploaded
+def benchmark_engines(local_dir,no_hidden):
+   global verbose
+
+   dirs=[]
+   for dir_name, subdir_list, file_list in mywalk(local_dir):
+      if not (no_hidden and is_hidden_dir(os.path.relpath(dir_name,local_dir))):
+         dirs.append([dir_name,file_list])
+
+   verbose=False
+   for name,bench in (("tar",bench_tar),("python",bench_python)):
+      start=time.time()
+      size=sum(bench(dir_name,file_list) for dir_name,file_list in dirs)
+      elapsed=max(time.time()-start,1e-6)
+      print_flush("%-6s engine: %d bundles, %d bytes in %.2fs "
+         "(%.1f bundles/s, %.1f MB/s)" % (name,len(dirs),size,elapsed,
+            len(dirs)/elapsed,size/elapsed/2**20))
+
 def usage():
    print("archive [parameters]")
    print("Parameters:")
@@ -409,6 +2329,38 @@ def usage():
    print("\t-p prefix")
    print("\t-P parallel_instances (default 3)")
    print("\t-m name:value (set object metadata)")
+   print("\t--stream (stream bundles to/from swift, no temp files)")
+   print("\t--incremental (only archive directories changed since last run)")
+   print("\t--codec gzip|pigz|zstd|lz4|none|auto (bundle compression, auto "
+      "skips incompressible directories)")
+   print("\t--walkers n (threads listing directories, default 1)")
+   print("\t--engine tar|python (archive engine, default tar)")
+   print("\t--benchmark (time archive engines on local_directory)")
+   print("\t--index-members (write member index for single file restores, "
+      "uses python engine)")
+   print("\t--restore pattern (with -x, only restore matching paths, "
+      "repeatable)")
+   print("\t--pack size (bundle directories smaller than size together, "
+      "e.g. 2G)")
+   print("\t--schedule (archive the largest bundle found so far whenever a "
+      "worker is free and report worker utilization)")
+   print("\t--split size (archive files of size or larger as bundles of "
+      "their own)")
+   print("\t--journal file (record finished bundles)")
+   print("\t--resume (skip bundles the journal has as finished, retry the "
+      "rest, default journal ~/.swbundler-journal-* or in temp_dir)")
+   print("\t--digests (store member md5s next to each bundle, uses python "
+      "engine)")
+   print("\t--verify (compare local_directory with the stored digests, "
+      "nothing else is downloaded)")
+   print("\t--pipeline f,d,w (with -x, fetch, decompress and write bundles "
+      "in stages of f, d and w threads)")
+   print("\t--expand (have swift unpack each directory into an object per "
+      "file, no --pack or --split)")
+   print("\t--cpus n (cores shared by the compressors of all instances, "
+      "default all)")
+   print("\t--tmp-budget size (temp space bundles in flight may use, default "
+      "90% of free space in temp_dir)")
 
 # is path a child of tree?
 def is_subtree(tree,path):
@@ -424,6 +2376,17 @@ def is_subtree(tree,path):
 
    return True
 
+# size with optional K, M, G or T suffix
+def parse_size(arg):
+   units={'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+   try:
+      if arg[-1].upper() in units:
+         return int(float(arg[:-1])*units[arg[-1].upper()])
+      return int(arg)
+   except (ValueError, IndexError):
+      print("Error: '%s' is not a valid size!" % arg)
+      sys.exit()
+
 def validate_dir(path,param):
    if not os.path.isdir(path):
       print("Error: %s '%s' is not accessible!" % (param,path))
@@ -436,12 +2399,74 @@ def validate_dir(path,param):
 
 def mywalk(top, skipdirs=['.snapshot']):
     """ returns subset of os.walk  """
+    if walkers>1:
+        yield from parallel_walk(top,skipdirs,walkers)
+        return
+
     for root, dirs, files in walk(top,topdown=True,onerror=walkerr):
         for skipdir in skipdirs:
             if skipdir in dirs:
                 dirs.remove(skipdir)  # don't visit this directory 
         yield root, dirs, files
 
+# list directory like os.walk: symlinks to directories are listed in dirs
+# but not descended into
+def list_dir(path):
+   dirs=[]
+   files=[]
+   with os.scandir(path) as entries:
+      for entry in entries:
+         try:
+            is_dir=entry.is_dir()
+         except OSError:
+            is_dir=False
+         if is_dir:
+            dirs.append([entry.name,entry.is_symlink()])
+         else:
+            files.append(entry.name)
+
+   return dirs,files
+
+# same results as mywalk, but directories are listed by many threads at
+# once and arrive in no particular order, at most queue_size listings are
+# held before the listing threads wait for the consumer
+def parallel_walk(top,skipdirs,threads,queue_size=1024):
+   todo=queue.Queue()
+   results=queue.Queue(queue_size)
+   pending=[1]
+   lock=threading.Lock()
+
+   def lister():
+      while True:
+         path=todo.get()
+         if path is None:
+            return
+         try:
+            dirs,files=list_dir(path)
+            dirs=[[name,link] for name,link in dirs if name not in skipdirs]
+            results.put([path,[name for name,link in dirs],files])
+         except OSError as err:
+            walkerr(err)
+            dirs=[]
+
+         descend=[os.path.join(path,name) for name,link in dirs if not link]
+         with lock:
+            pending[0]+=len(descend)-1
+            done=(pending[0]==0)
+         for child in descend:
+            todo.put(child)
+         if done:
+            for i in range(threads):
+               todo.put(None)
+            results.put(None)
+
+   for i in range(threads):
+      threading.Thread(target=lister,daemon=True).start()
+   todo.put(top)
+
+   for item in iter(results.get,None):
+      yield item
+
 def walkerr(oserr):
     sys.stderr.write(str(oserr))
     sys.stderr.write('\n')
@@ -451,6 +2476,12 @@ def main(argv=None):
    global swift_auth_token
    global storage_url
    global haz_pigz
+   global index_members
+   global engine
+   global codec,auto_codec
+   global walkers
+   global temp_budget,cpu_budget
+   global expand,digests
    argv = argv or sys.argv[1:]
 
    meta=[]
@@ -462,9 +2493,27 @@ def main(argv=None):
    no_hidden=False
    prefix=""
    par=3
+   stream=False
+   incremental=False
+   pack_size=0
+   patterns=[]
+   benchmark=False
+   schedule=False
+   split_size=0
+   journal_path=""
+   resume=False
+   tmp_budget=0
+   verify=False
+   stages=None
+   cpus=len(os.sched_getaffinity(0)) if hasattr(os,"sched_getaffinity") \
+      else os.cpu_count()
 
    try:
-      opts,args=getopt.getopt(argv,"l:c:t:a:s:p:P:S:m:xnh")
+      opts,args=getopt.getopt(argv,"l:c:t:a:s:p:P:S:m:xnh",["stream",
+         "incremental","pack=","index-members","restore=","engine=",
+         "benchmark","codec=","walkers=","schedule","split=","journal=",
+         "resume","tmp-budget=","cpus=","expand","digests","verify",
+         "pipeline="])
    except getopt.GetoptError:
       usage()
       sys.exit()
@@ -499,18 +2548,107 @@ def main(argv=None):
          else:
             print("Error: metadata not in format key:value!")
             sys.exit()
+      elif opt in ("--stream",): # no temp files, stream to/from swift
+         stream=True
+      elif opt in ("--incremental",): # skip unchanged directories
+         incremental=True
+      elif opt in ("--pack",): # coalesce small directories
+         pack_size=parse_size(arg)
+      elif opt in ("--index-members",): # member index for range restores
+         index_members=True
+      elif opt in ("--restore",): # restore only matching members
+         patterns.append(arg)
+      elif opt in ("--engine",): # archive engine
+         if arg not in ("tar","python"):
+            print("Error: engine must be tar or python!")
+            sys.exit()
+         engine=arg
+      elif opt in ("--benchmark",): # compare archive engines
+         benchmark=True
+      elif opt in ("--codec",): # bundle compression
+         if arg not in ("gzip","pigz","zstd","lz4","none","auto"):
+            print("Error: codec must be gzip, pigz, zstd, lz4, none or auto!")
+            sys.exit()
+         codec=arg
+      elif opt in ("--walkers",): # parallel directory listing
+         walkers=int(arg)
+      elif opt in ("--schedule",): # largest first, utilization report
+         schedule=True
+      elif opt in ("--split",): # large files in bundles of their own
+         split_size=parse_size(arg)
+      elif opt in ("--journal",): # record of finished bundles
+         journal_path=arg
+      elif opt in ("--resume",): # continue from the journal
+         resume=True
+      elif opt in ("--tmp-budget",): # temp space for bundles in flight
+         tmp_budget=parse_size(arg)
+      elif opt in ("--cpus",): # cores for compressors
+         cpus=int(arg)
+      elif opt in ("--expand",): # bulk extract into objects per file
+         expand=True
+      elif opt in ("--digests",): # member digests for verify
+         digests=True
+      elif opt in ("--verify",): # check local tree against digests
+         verify=True
+      elif opt in ("--pipeline",): # staged extract
+         stages=[int(n) for n in arg.split(',')]
+         if len(stages)!=3 or min(stages)<1:
+            print("Error: pipeline must be fetch,decompress,write threads!")
+            sys.exit()
+
+   if patterns and not extract:
+      print("Error: --restore only works with -x!")
+      sys.exit()
+
+   # member index and digests need the in process engine
+   if index_members or digests:
+      engine="python"
+
+   # expanded directories are objects per file, there is nothing to pack
+   if expand:
+      pack_size=0
+      split_size=0
+
+   if find_executable("pigz"):
+      haz_pigz=True
+
+   # auto uses the best compressor available for compressible directories
+   if find_executable("zstd"):
+      auto_codec="zstd"
+   elif haz_pigz:
+      auto_codec="pigz"
+
+   if codec in ("pigz","zstd","lz4") and not find_executable(codec):
+      print("Error: %s not found!" % codec)
+      sys.exit()
+
+   # temp bundles wait for space rather than fill the temp directory
+   if not stream:
+      if not tmp_budget:
+         fs=os.statvfs(tmp_dir or ".")
+         tmp_budget=fs.f_bavail*fs.f_frsize*9//10
+      temp_budget=TempBudget(tmp_budget)
+
+   # compressor threads are split between the instances compressing
+   cpu_budget=CpuBudget(cpus,par)
 
-   if not container:
+   # the journal is only kept when asked for
+   if container and resume and not journal_path:
+      journal_path=journal_file(tmp_dir,container,prefix,extract)
+
+   if benchmark:
+      benchmark_engines(local_dir,no_hidden)
+   elif not container:
       usage()
+   elif verify:
+      verify_local(local_dir,container,no_hidden,prefix,par)
+   elif extract:
+      extract_to_local(local_dir,container,no_hidden,tmp_dir,prefix,par,
+         stream,patterns,journal_path,resume,stages)
    else:
-      if find_executable("pigz"):
-         haz_pigz=True
-
-      if extract:
-         extract_to_local(local_dir,container,no_hidden,tmp_dir,prefix,par)
-      else:
-         archive_to_swift(local_dir,container,no_hidden,tmp_dir,prefix,par,
-            sub_tree,meta)
+      archive_to_swift(local_dir,container,no_hidden,tmp_dir,prefix,par,
+         sub_tree,meta,stream,incremental,pack_size,schedule,split_size,
+         journal_path,resume)
 
 if __name__=="__main__":
    main()
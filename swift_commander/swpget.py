@@ -2,21 +2,37 @@
 
 # get multisegment swift files in parallel
 
-import sys,os,getopt,json
+import sys,os,getopt,json,fnmatch
 import time
+import hashlib
+import threading
 
 import multiprocessing
 
 import swiftclient
 
-def create_sparse_file(filename,length):
+# with keep an existing file is only resized, its data is left alone
+def create_sparse_file(filename,length,keep=False):
    #print("creating sparse file",filename)
-   with open(filename, "wb") as f:
+   with open(filename, "r+b" if keep and os.path.exists(filename) else "wb") \
+      as f:
       f.truncate(length)
 
 swift_auth_token=os.environ.get("OS_AUTH_TOKEN")
 storage_url=os.environ.get("OS_STORAGE_URL")
 
+# segments are streamed in chunks of this size, peak memory is about
+# pool_size*chunk_size
+chunk_size=1048576
+# plain objects and DLOs of at least twice this size are fetched as
+# parallel byte ranges of at least this size
+min_range_size=67108864
+# a segment that fails or doesn't match its manifest md5 is fetched again
+# this often, completed segments are kept in dest+state_suffix until the
+# whole object is done
+segment_retries=3
+state_suffix=".swpget-state"
+
 def create_sw_conn():
    global swift_auth_token,storage_url
 
@@ -42,52 +58,158 @@ def parseSwiftUrl(path):
     obj = '/'.join(components[1:])
     return container, obj
 
-# container, object, offset, dest
+# positional write of all of data, no shared file offset between workers
+def pwrite_all(fd,data,offset):
+   data=memoryview(data)
+   while data:
+      written=os.pwrite(fd,data,offset)
+      data=data[written:]
+      offset+=written
+
+# md5 of length bytes of filename from offset
+def range_md5(filename,offset,length):
+   global chunk_size
+
+   md5=hashlib.md5()
+   fd=os.open(filename,os.O_RDONLY)
+   try:
+      while length>0:
+         data=os.pread(fd,min(chunk_size,length),offset)
+         if not data:
+            break
+         md5.update(data)
+         offset+=len(data)
+         length-=len(data)
+   finally:
+      os.close(fd)
+
+   return md5.hexdigest()
+
+# container, object, offset, dest, byte range or None, size, md5 or None,
+# check local data first; returns [dest, md5 of the data written, error or
+# None, offset]
 def assemble_ms_object(x):
+   global chunk_size,segment_retries
+
    #print("assembling",x) 
+   # a segment completed by an earlier run is only read back
+   if x[7] and range_md5(x[3],x[2],x[5])==x[6]:
+      return [x[3],x[6],None,x[2]]
+
    conn=create_sw_conn()
 
-   headers,body=conn.get_object(x[0],x[1])
-   #print("body len=",len(body))
-   with open(x[3],"r+b") as f_out:
-      if x[2]>0:
-         f_out.seek(x[2])
-      f_out.write(bytes(body))
+   request_headers={}
+   if x[4]:
+      request_headers['Range']="bytes=%d-%d" % tuple(x[4])
+   for attempt in range(segment_retries+1):
+      md5=hashlib.md5()
+      error=None
+      try:
+         headers,body=conn.get_object(x[0],x[1],resp_chunk_size=chunk_size,
+            headers=request_headers)
+         fd=os.open(x[3],os.O_WRONLY)
+         try:
+            offset=x[2]
+            for chunk in body:
+               md5.update(chunk)
+               pwrite_all(fd,chunk,offset)
+               offset+=len(chunk)
+         finally:
+            os.close(fd)
+      except (swiftclient.ClientException, swiftclient.RequestException, 
+         OSError) as err:
+         error=str(err)
+
+      if not error and x[6] and md5.hexdigest()!=x[6]:
+         error="%s/%s does not match its manifest md5" % (x[0],x[1])
+      if not error:
+         break
 
    conn.close()
+   return [x[3],md5.hexdigest(),error,x[2]]
+
+# completed segments of dest as offset->md5, if its state file is for this
+# manifest and dest is still there
+def read_state(dest,manifest_md5):
+   global state_suffix
 
-def get_ms_object(sc,container,object,pool_size):
+   done={}
+   if not os.path.exists(dest):
+      return done
+   try:
+      with open(dest+state_suffix) as f:
+         if json.loads(f.readline()).get("manifest")!=manifest_md5:
+            return done
+         for line in f:
+            try:
+               segment=json.loads(line)
+            except ValueError:
+               # line cut short when the last run stopped
+               continue
+            done[segment["offset"]]=segment["hash"]
+   except (OSError, ValueError):
+      pass
+
+   return done
+
+# segment tasks of an SLO from its manifest, into a sparse file of the
+# object's size, segments done lists offset->md5 of segments already there
+def get_ms_object(manifest,dest,done=None):
    #print("multisegment object",object)
    segments=[]
    segment_total=0
+   done=done or {}
 
    # build segment map for parallel download
-   headers,body=sc.get_object(container,object,
-      query_string='multipart-manifest=get')
-   manifest=json.loads(body.decode())
-   dest=os.path.basename(object)
    for segment in manifest:
       segment_container,segment_obj=parseSwiftUrl(segment['name'])
-      # store segment container, object and offset
-      segments.append([segment_container,segment_obj,segment_total,dest])
+      # the hash of a nested SLO or a segment range isn't its content md5
+      md5=segment['hash']
+      if segment.get('sub_slo') or 'range' in segment:
+         md5=None
+      # store segment container, object, offset, dest, size and md5
+      segments.append([segment_container,segment_obj,segment_total,dest,
+         None,segment['bytes'],md5,
+         md5 is not None and done.get(segment_total)==md5])
       segment_total=segment_total+segment['bytes']
 
-   # create sparse file
-   create_sparse_file(dest,segment_total)
+   # create sparse file, keeping the segments of an earlier run
+   create_sparse_file(dest,segment_total,bool(done))
 
-   # sequential assembly
-   #for seg in segments:
-   #   assemble_ms_object(seg)
+   return segments
 
-   # parallel assembly
-   #print("parallel assembly with",pool_size,"workers")
-   p=multiprocessing.Pool(pool_size)
-   p.map(assemble_ms_object,segments)
+def file_md5(filename):
+   global chunk_size
+
+   md5=hashlib.md5()
+   with open(filename,"rb") as f:
+      for data in iter(lambda:f.read(chunk_size),b''):
+         md5.update(data)
 
-def get_object(conn,container,object):
-   headers,body=conn.get_object(container,object)
-   with open(os.path.basename(object),"w+b") as f_out:
-      f_out.write(bytes(body))
+   return md5.hexdigest()
+
+# dest, returns [dest, md5, error]; a plain object downloaded in ranges is
+# hashed as a pool task so the pool's result thread doesn't read it back
+def md5_worker(x):
+   try:
+      return [x[0],file_md5(x[0]),None]
+   except OSError as err:
+      return [x[0],None,str(err)]
+
+# tasks of a plain object or DLO, large ones are split into byte ranges
+def get_object(container,object,dest,size,pool_size):
+   global min_range_size
+
+   create_sparse_file(dest,size)
+
+   ranges=min(pool_size,size//min_range_size)
+   if ranges<2:
+      return [[container,object,0,dest,None,size,None,False]]
+
+   range_size=-(-size//ranges)
+   return [[container,object,start,dest,[start,min(start+range_size,size)-1],
+      min(range_size,size-start),None,False] 
+         for start in range(0,size,range_size)]
 
 def set_time(headers,name):
    if headers:
@@ -98,37 +220,254 @@ def set_time(headers,name):
             "%a, %d %b %Y %X %Z"))
          mmt=int(time.mktime(time.localtime(mkt)))
 
-      os.utime(os.path.basename(name),(mmt,mmt))
+      os.utime(name,(mmt,mmt))
+
+# object path under the local directory, None if it would end up outside
+def local_path(object):
+   dest=os.path.normpath(object.lstrip('/'))
+   if dest=='.' or dest=='..' or dest.startswith('../'):
+      return None
+
+   return dest
+
+# check a downloaded object against its etag and set its time, the etag of
+# a plain object is the md5 of its content, SLO and DLO etags are not;
+# job's md5 is that of the whole file
+def finish_object(dest,job):
+   global state_suffix
+
+   headers=job["headers"]
+   if job.get("state"):
+      job["state"].close()
+      if not job["error"]:
+         os.unlink(dest+state_suffix)
+
+   if job["error"]:
+      print("Error: cannot download '%s': %s" % (job["object"],job["error"]))
+      return
+
+   if not ('x-static-large-object' in headers or 
+      'x-object-manifest' in headers):
+      etag=headers.get('etag','').strip('"')
+      if etag and job["md5"]!=etag:
+         print("Error: '%s' does not match its etag!" % job["object"])
 
+   set_time(headers,dest)
+
+# container, object, dest, pool_size; the only request made per object,
+# an SLO's manifest comes back, anything small is downloaded right away,
+# returns [kind, dest, headers, the manifest, md5 or error]
+def fetch_object(x):
+   global chunk_size,min_range_size
+
+   conn=create_sw_conn()
+   try:
+      headers,body=conn.get_object(x[0],x[1],
+         query_string='multipart-manifest=get',resp_chunk_size=chunk_size)
+      if 'x-static-large-object' in headers:
+         result=["slo",x[2],headers,json.loads(b''.join(body).decode())]
+      elif 'x-object-manifest' in headers:
+         # that was the DLO's own manifest object, ranges need its size
+         result=["ranges",x[2],conn.head_object(x[0],x[1]),None]
+      elif min(x[3],int(headers.get('content-length',0))//min_range_size)>1:
+         result=["ranges",x[2],headers,None]
+      else:
+         md5=hashlib.md5()
+         with open(x[2],"wb") as f_out:
+            for chunk in body:
+               md5.update(chunk)
+               f_out.write(chunk)
+         result=["done",x[2],headers,md5.hexdigest()]
+   except swiftclient.ClientException as err:
+      if err.http_status==404:
+         result=["missing",x[2],{},None]
+      else:
+         result=["error",x[2],{},str(err)]
+   except (swiftclient.RequestException, OSError, ValueError) as err:
+      result=["error",x[2],{},str(err)]
+
+   conn.close()
+   return result
+
+# names of objects in container starting with prefix, a page at a time
+def list_prefix(sc,container,prefix):
+   marker=""
+   while True:
+      headers,objs=sc.get_container(container,prefix=prefix,marker=marker)
+      if not objs:
+         return
+      for obj in objs:
+         yield obj['name']
+      marker=objs[-1]['name']
+
+# literal names are used as they are, names ending in / and glob patterns
+# are listed with their literal prefix as the server side prefix
+def select_objects(sc,container,object_list):
+   seen=set()
+   for pattern in object_list:
+      magic=[pos for pos,char in enumerate(pattern) if char in "*?["]
+      if magic:
+         names=(name for name in list_prefix(sc,container,pattern[:magic[0]])
+            if fnmatch.fnmatchcase(name,pattern))
+      elif pattern.endswith('/'):
+         names=list_prefix(sc,container,pattern)
+      else:
+         names=[pattern]
+
+      for name in names:
+         if name not in seen:
+            seen.add(name)
+            yield name
+
+# segments, ranges and whole objects of every requested object go through
+# one pool, objects are finished as their last task completes
 def get_objects(sc,container,object_list,pool_size):
    found=0
+   jobs={}
    #print("getting",object_list,"from container",container)
 
-   try:
-      headers,objs=sc.get_container(container,full_listing=True)
-      for obj in objs:
-         #print("found",obj['name'])
-         if obj['name'] in object_list:
-            #print("matched",obj['name'])
-            found=found+1
-            try:
-               headers=sc.head_object(container, obj['name'])
-            except:
-               headers=[]
-           
-            if 'x-static-large-object' in headers:
-               get_ms_object(sc,container,obj['name'],pool_size)
-            else:
-               get_object(sc,container,obj['name'])
+   p=multiprocessing.Pool(pool_size)
+   # bound objects waiting in the pool so the listing can't run far ahead,
+   # their segment and range tasks are not held back
+   inflight=threading.Semaphore(pool_size*4)
+   outstanding=[0]
+   lock=threading.Condition()
+
+   def submit(func,task,callback,follow=False):
+      if not follow:
+         inflight.acquire()
+      with lock:
+         outstanding[0]+=1
+      p.apply_async(func,[task],
+         callback=lambda result:finished(callback,result,follow),
+         error_callback=lambda err:finished(None,err,follow))
+
+   # runs in the pool's result thread
+   def finished(callback,result,follow):
+      try:
+         if callback:
+            callback(result)
+         else:
+            print("Error: %s" % result)
+      except (OSError, ValueError, KeyError) as err:
+         print("Error: %s" % err)
+      finally:
+         if not follow:
+            inflight.release()
+         with lock:
+            outstanding[0]-=1
+            lock.notify_all()
+
+   def assembled(result):
+      dest,md5,error,offset=result
+      job=jobs[dest]
+      job["remaining"]-=1
+      job["md5"]=md5
+      job["error"]=job["error"] or error
+      if job.get("state") and not error:
+         job["state"].write(json.dumps({"offset":offset,"hash":md5})+"\n")
+         job["state"].flush()
+      if not job["remaining"]:
+         complete(dest)
+
+   # a plain object fetched in ranges is hashed as a whole before it is
+   # finished
+   def complete(dest):
+      job=jobs[dest]
+      headers=job["headers"]
+      if job["tasks"]>1 and not job["error"] and not (
+         'x-static-large-object' in headers or 
+         'x-object-manifest' in headers):
+         submit(md5_worker,[dest],hashed,True)
+      else:
+         finish_object(dest,job)
+
+   def hashed(result):
+      dest,md5,error=result
+      jobs[dest]["md5"]=md5
+      jobs[dest]["error"]=error
+      finish_object(dest,jobs[dest])
+
+   def fetched(result):
+      nonlocal found
+      global state_suffix
+
+      kind,dest,headers,extra=result
+      if kind=="missing":
+         print("Error: object '%s' not found!" % names[dest])
+         return
+      found=found+1
+
+      jobs[dest]={"object":names[dest],"headers":headers,"tasks":1,
+         "remaining":0,"md5":None,"error":None}
+      if kind=="error":
+         jobs[dest]["error"]=extra
+      elif kind=="done":
+         jobs[dest]["md5"]=extra
+      elif kind=="slo":
+         manifest_md5=hashlib.md5(json.dumps(extra,sort_keys=True).encode()
+            ).hexdigest()
+         done=read_state(dest,manifest_md5)
+         object_tasks=get_ms_object(extra,dest,done)
+         # segments of the old state are read back before they are skipped
+         jobs[dest]["state"]=open(dest+state_suffix,"w")
+         jobs[dest]["state"].write(json.dumps({"manifest":manifest_md5})+"\n")
+         for offset,md5 in sorted(done.items()):
+            jobs[dest]["state"].write(json.dumps({"offset":offset,
+               "hash":md5})+"\n")
+         jobs[dest]["state"].flush()
+      else:
+         object_tasks=get_object(container,names[dest],dest,
+            int(headers.get('content-length',0)),pool_size)
 
-            set_time(headers,obj['name'])
+      if kind in ("error","done") or not object_tasks:
+         finish_object(dest,jobs[dest])
+         return
 
-      if not found:
-         print("No matching files found")
+      jobs[dest]["tasks"]=jobs[dest]["remaining"]=len(object_tasks)
+      for task in object_tasks:
+         submit(assemble_ms_object,task,assembled,True)
 
+   names={}
+   try:
+      for name in select_objects(sc,container,object_list):
+         # pseudo-directory markers hold no data, their directory is made
+         # for the objects below them
+         if name.endswith('/'):
+            continue
+         dest=local_path(name)
+         if not dest:
+            print("Error: '%s' is outside the local directory!" % name)
+            continue
+         if dest in names:
+            print("Error: '%s' and '%s' are the same local file!" % 
+               (names[dest],name))
+            continue
+         # a and a/b can't both be downloaded, whichever comes second fails
+         try:
+            if os.path.dirname(dest):
+               os.makedirs(os.path.dirname(dest),exist_ok=True)
+         except OSError as err:
+            print("Error: cannot download '%s': %s" % (name,err))
+            continue
+         if os.path.isdir(dest):
+            print("Error: cannot download '%s': '%s' is a directory!" % 
+               (name,dest))
+            continue
+         names[dest]=name
+         submit(fetch_object,[container,name,dest,pool_size],fetched)
    except swiftclient.ClientException:
       print("Error: cannot access Swift container '%s'!" % container)
 
+   with lock:
+      while outstanding[0]:
+         lock.wait()
+   p.close()
+   p.join()
+
+   if not found:
+      print("No matching files found")
+
    sc.close()
 
 def validate_dir(path,param):
@@ -141,18 +480,33 @@ def validate_dir(path,param):
 
    return(path)
 
+# size with optional K, M, G or T suffix
+def parse_size(arg):
+   units={'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+   try:
+      if arg[-1].upper() in units:
+         return int(float(arg[:-1])*units[arg[-1].upper()])
+      return int(arg)
+   except (ValueError, IndexError):
+      print("Error: '%s' is not a valid size!" % arg)
+      sys.exit()
+
 def usage():
-   print("swpget [parameters]")
+   print("swpget [parameters] object ...")
+   print("Objects are names, prefixes ending in / or glob patterns")
    print("Parameters:")
    print("\t-l local_directory (default .)")
    print("\t-c container (required)")
    print("\t-p pool_size (default 5)")
+   print("\t-r min_range_size (split large objects into parallel ranges of "
+      "at least this, default 64M)")
    print("\t-a auth_token (default OS_AUTH_TOKEN)")
    print("\t-s storage_url (default OS_STORAGE_URL)")
 
 def main(argv=None):
    global swift_auth_token
    global storage_url
+   global min_range_size
 
    argv = argv or sys.argv[1:]
 
@@ -160,7 +514,7 @@ def main(argv=None):
    pool_size=5
 
    try:
-      opts,args=getopt.getopt(argv,"l:c:p:a:s:h")
+      opts,args=getopt.getopt(argv,"l:c:p:r:a:s:h")
    except getopt.GetoptError:
       usage()
       sys.exit()
@@ -176,6 +530,8 @@ def main(argv=None):
          container=arg
       elif opt in ("-p"): # parallel workers
          pool_size=int(arg)
+      elif opt in ("-r"): # minimum byte range size
+         min_range_size=parse_size(arg)
       elif opt in ("-a"): # override swift_auth_token
          swift_auth_token=arg
       elif opt in ("-s"): # override storage URL
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# put large files to swift as parallel segments of a static large object
+
+import sys,os,getopt,json
+import hashlib
+
+import multiprocessing
+
+import swiftclient
+
+swift_auth_token=os.environ.get("OS_AUTH_TOKEN")
+storage_url=os.environ.get("OS_STORAGE_URL")
+
+# segments are read and sent in chunks of this size
+chunk_size=1048576
+# without -z the segment size is picked per file so the pool has a few
+# segments per worker, within these limits and at most max_segments
+min_segment_size=67108864
+max_segment_size=5368709120
+max_segments=1000
+# a segment that fails or comes back with another etag is put again this
+# often
+segment_retries=3
+
+def create_sw_conn():
+   global swift_auth_token,storage_url
+
+   if swift_auth_token and storage_url:
+      return swiftclient.Connection(preauthtoken=swift_auth_token,
+         preauthurl=storage_url)
+
+   swift_auth=os.environ.get("ST_AUTH")
+   swift_user=os.environ.get("ST_USER")
+   swift_key=os.environ.get("ST_KEY")
+
+   if swift_auth and swift_user and swift_key:
+      return swiftclient.Connection(authurl=swift_auth,user=swift_user,
+         key=swift_key)
+
+   print("Error: Swift environment not configured!")
+   sys.exit()
+
+# file-like view of length bytes of fd from offset, read with positional
+# reads and hashed on the way through, swiftclient only rewinds it to the
+# start when it retries a request
+class SegmentReader:
+   def __init__(self,fd,offset,length):
+      self.fd=fd
+      self.offset=offset
+      self.length=length
+      self.seek(0)
+
+   def read(self,size=-1):
+      remaining=self.length-self.pos
+      if size is None or size<0 or size>remaining:
+         size=remaining
+      if size<=0:
+         return b''
+      data=os.pread(self.fd,size,self.offset+self.pos)
+      self.md5.update(data)
+      self.pos+=len(data)
+      return data
+
+   def tell(self):
+      return self.pos
+
+   def seek(self,pos,whence=0):
+      self.pos=pos
+      self.md5=hashlib.md5()
+
+   def hexdigest(self):
+      # hash whatever the request didn't read
+      while self.read(chunk_size):
+         pass
+      return self.md5.hexdigest()
+
+# segment size for a file, size is rounded up to a whole MiB
+def segment_size_for(size,pool_size):
+   global min_segment_size,max_segment_size,max_segments
+
+   segment_size=-(-size//(pool_size*4))
+   segment_size=max(min_segment_size,min(segment_size,max_segment_size))
+   segment_size=max(segment_size,-(-size//max_segments))
+   return -(-segment_size//1048576)*1048576
+
+# segment objects already in the segment container under prefix as
+# name->[hash, bytes]
+def list_segments(sc,container,prefix):
+   segments={}
+   marker=""
+   try:
+      while True:
+         headers,objs=sc.get_container(container,prefix=prefix,
+            marker=marker)
+         if not objs:
+            break
+         for obj in objs:
+            segments[obj['name']]=[obj['hash'],obj['bytes']]
+         marker=objs[-1]['name']
+   except swiftclient.ClientException as err:
+      if err.http_status!=404:
+         raise
+
+   return segments
+
+# container, object, filename, offset, length, index, etag of a copy that
+# is already there or None; returns [filename, index, md5, error, sent]
+def put_segment(x):
+   global chunk_size,segment_retries
+
+   try:
+      fd=os.open(x[2],os.O_RDONLY)
+   except OSError as err:
+      return [x[2],x[5],None,str(err),False]
+
+   try:
+      # a segment left by an earlier run is kept if its data is unchanged
+      if x[6] and SegmentReader(fd,x[3],x[4]).hexdigest()==x[6]:
+         return [x[2],x[5],x[6],None,False]
+
+      conn=create_sw_conn()
+      for attempt in range(segment_retries+1):
+         reader=SegmentReader(fd,x[3],x[4])
+         md5=None
+         error=None
+         try:
+            etag=conn.put_object(x[0],x[1],reader,content_length=x[4],
+               chunk_size=chunk_size)
+            md5=reader.hexdigest()
+            if etag and etag.strip('"')!=md5:
+               error="%s/%s etag doesn't match the data sent" % (x[0],x[1])
+         except (swiftclient.ClientException, swiftclient.RequestException,
+            OSError) as err:
+            error=str(err)
+         if not error:
+            break
+      conn.close()
+   finally:
+      os.close(fd)
+
+   return [x[2],x[5],md5,error,True]
+
+# mtime as swift upload writes it, in segment names and the manifest
+def file_mtime(filename):
+   return "%f" % os.path.getmtime(filename)
+
+# segments of the SLO at container/object as [container, name], empty if
+# there is none
+def manifest_segments(sc,container,object):
+   try:
+      headers=sc.head_object(container,object)
+      if headers.get('x-static-large-object','').lower()!='true':
+         return []
+      headers,body=sc.get_object(container,object,
+         query_string='multipart-manifest=get')
+   except swiftclient.ClientException as err:
+      if err.http_status==404:
+         return []
+      raise
+
+   return [segment['name'].lstrip('/').split('/',1) 
+      for segment in json.loads(body)]
+
+# segment tasks of filename and the names they get in segment_container,
+# segments named as swift upload --use-slo does so a rerun of either tool
+# finds them again
+def segment_tasks(sc,filename,object,segment_container,segment_size):
+   stat=os.stat(filename)
+   prefix="%s/slo/%s/%d/%d/" % (object,file_mtime(filename),stat.st_size,
+      segment_size)
+   existing=list_segments(sc,segment_container,prefix)
+
+   tasks=[]
+   for index,offset in enumerate(range(0,stat.st_size,segment_size)):
+      length=min(segment_size,stat.st_size-offset)
+      name="%s%08d" % (prefix,index)
+      etag=None
+      if name in existing and existing[name][1]==length:
+         etag=existing[name][0]
+      tasks.append([segment_container,name,filename,offset,length,index,
+         etag])
+
+   return tasks
+
+# SLO manifest of filename's segments, with its mtime for swpget
+def put_manifest(sc,container,object,filename,tasks,md5s):
+   manifest=[{"path":"/%s/%s" % (task[0],task[1]),"etag":md5s[task[5]],
+      "size_bytes":task[4]} for task in tasks]
+   sc.put_object(container,object,json.dumps(manifest),
+      query_string='multipart-manifest=put',
+      headers={'x-object-meta-mtime':file_mtime(filename)})
+
+# segments of the object's earlier upload that the new one doesn't use, as
+# swift upload does unless --leave-segments is given
+def delete_segments(sc,segments,tasks):
+   keep=set((task[0],task[1]) for task in tasks)
+   for container,name in segments:
+      if (container,name) in keep:
+         continue
+      try:
+         sc.delete_object(container,name)
+      except swiftclient.ClientException as err:
+         if err.http_status!=404:
+            print("Error: cannot delete old segment '%s/%s': %s" % 
+               (container,name,err))
+
+# object name of a local path, relative to the current directory
+def object_name(filename):
+   return os.path.normpath(filename).lstrip('/')
+
+# files of file_list go through one pool as segments or whole objects,
+# a file's manifest is written as its last segment completes
+def put_files(sc,container,file_list,object,pool_size,segment_size):
+   segment_container=container+"_segments"
+   segments_created=False
+   jobs={}
+   tasks=[]
+
+   try:
+      sc.put_container(container)
+      for filename in file_list:
+         if not os.path.isfile(filename):
+            print("Error: '%s' is not a file!" % filename)
+            continue
+         name=object or object_name(filename)
+         size=os.path.getsize(filename)
+         old_segments=manifest_segments(sc,container,name)
+         if segment_size:
+            file_segment_size=max(segment_size,-(-size//max_segments))
+         else:
+            file_segment_size=segment_size_for(size,pool_size)
+         manifest=size>file_segment_size
+         if manifest:
+            if not segments_created:
+               sc.put_container(segment_container)
+               segments_created=True
+            file_tasks=segment_tasks(sc,filename,name,segment_container,
+               file_segment_size)
+         else:
+            # small enough to go in one piece as a plain object
+            file_tasks=[[container,name,filename,0,size,0,None]]
+         jobs[filename]={"object":name,"tasks":file_tasks,
+            "remaining":len(file_tasks),"md5s":{},"error":None,"sent":0,
+            "manifest":manifest,"old_segments":old_segments}
+         tasks.extend(file_tasks)
+   except swiftclient.ClientException as err:
+      print("Error: cannot access Swift container '%s': %s" % (container,err))
+      return
+
+   p=multiprocessing.Pool(pool_size)
+   for filename,index,md5,error,sent in p.imap_unordered(put_segment,tasks):
+      job=jobs[filename]
+      job["remaining"]-=1
+      job["md5s"][index]=md5
+      job["error"]=job["error"] or error
+      job["sent"]+=sent
+      if job["remaining"]:
+         continue
+
+      if job["error"]:
+         print("Error: cannot upload '%s': %s" % (filename,job["error"]))
+         continue
+      if job["manifest"]:
+         try:
+            put_manifest(sc,container,job["object"],filename,job["tasks"],
+               job["md5s"])
+         except swiftclient.ClientException as err:
+            print("Error: cannot write manifest of '%s': %s" %
+               (job["object"],err))
+            continue
+         print("%s: %d of %d segments uploaded" %
+            (job["object"],job["sent"],len(job["tasks"])))
+      delete_segments(sc,job["old_segments"],job["tasks"])
+   p.close()
+   p.join()
+
+   sc.close()
+
+# size with optional K, M, G or T suffix
+def parse_size(arg):
+   units={'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+   try:
+      if arg[-1].upper() in units:
+         return int(float(arg[:-1])*units[arg[-1].upper()])
+      return int(arg)
+   except (ValueError, IndexError):
+      print("Error: '%s' is not a valid size!" % arg)
+      sys.exit()
+
+def usage():
+   print("swpput [parameters] file ...")
+   print("Files larger than a segment are uploaded as static large objects")
+   print("Parameters:")
+   print("\t-c container (required, segments go to container_segments)")
+   print("\t-o object name (single file only, default the file's path)")
+   print("\t-p pool_size (default 5)")
+   print("\t-z segment_size (default picked per file, at most %d segments)"
+      % max_segments)
+   print("\t-a auth_token (default OS_AUTH_TOKEN)")
+   print("\t-s storage_url (default OS_STORAGE_URL)")
+
+def main(argv=None):
+   global swift_auth_token
+   global storage_url
+
+   argv = argv or sys.argv[1:]
+
+   container=""
+   object=""
+   pool_size=5
+   segment_size=0
+
+   try:
+      opts,args=getopt.getopt(argv,"c:o:p:z:a:s:h")
+   except getopt.GetoptError:
+      usage()
+      sys.exit()
+
+   for opt,arg in opts:
+      if opt in ("-h"):
+         container=""
+         break
+      elif opt in ("-c"): # set container
+         container=arg
+      elif opt in ("-o"): # object name of a single file
+         object=arg
+      elif opt in ("-p"): # parallel workers
+         pool_size=int(arg)
+      elif opt in ("-z"): # segment size
+         segment_size=parse_size(arg)
+      elif opt in ("-a"): # override swift_auth_token
+         swift_auth_token=arg
+      elif opt in ("-s"): # override storage URL
+         storage_url=arg
+
+   if not container or not args or (object and len(args)>1):
+      usage()
+   else:
+      sc=create_sw_conn()
+      if sc:
+         put_files(sc,container,args,object,pool_size,segment_size)
+
+if __name__ == '__main__':
+   main()
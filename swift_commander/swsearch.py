@@ -5,15 +5,24 @@
 import re
 import argparse
 import fnmatch
-import psutil
 
 import sys,os,getopt,json
 import time
+import io,gzip,bz2,lzma,tarfile,zipfile
+import itertools,functools
+import sqlite3
+import threading
+import subprocess
 
 import multiprocessing
 
 import swiftclient
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick=None
+
 def create_sw_conn(swift_auth_token,storage_url):
     if swift_auth_token and storage_url:
         return swiftclient.Connection(preauthtoken=swift_auth_token,
@@ -33,32 +42,494 @@ def create_sw_conn(swift_auth_token,storage_url):
 textchars=bytearray({7,8,9,10,12,13,27}|set(range(0x20, 0x100))-{0x7f})
 is_binary_string=lambda bytes:bool(bytes.translate(None,textchars))
 
-def print_match(object,body,pattern,range=25):
-    offset=body.find(pattern)
-    if offset!=-1:
-        print("%s: matched at offset %d" % (object,offset),flush=True)
-        excerpt=body[max(0,offset-range):offset+len(pattern)+range]
-        print('\t'+repr(excerpt.decode(encoding="ISO-8859-1")))
+# objects are streamed in chunks of this size, the last bytes of a chunk
+# are searched again with the next one so matches across the boundary are
+# found; a case insensitive pattern is a regular expression and is only
+# found across a boundary if its match is at most max_match bytes
+chunk_size=1048576
+max_match=4096
+
+# patterns set by compile_patterns before the pool starts: literals go
+# into an Aho-Corasick automaton with pyahocorasick or else a regex of
+# their prefix trie, either way every occurrence of every literal is found
+# in one pass, overlapping ones included; the -i pattern is a regex
+regex=None
+automaton=None
+keys=None
+lengths=None
+fold=False
+overlap=0
+literals=None
+
+# regex alternation of the prefix trie of sorted keys, literals sharing a
+# prefix share its branch so the regex walks each position only once
+def literal_trie(keys):
+    root={}
+    for key in keys:
+        node=root
+        for byte in key:
+            node=node.setdefault(byte,{})
+        node[None]=True
+
+    def branch(node):
+        alts=[re.escape(bytes([byte]))+branch(child) 
+            for byte,child in sorted(item for item in node.items() 
+                if item[0] is not None)]
+        if not alts:
+            return b''
+        alt=alts[0] if len(alts)==1 else b'(?:'+b'|'.join(alts)+b')'
+        return b'(?:'+alt+b')?' if None in node else alt
+
+    return branch(root)
+
+def compile_patterns(parse_arg):
+    global regex,automaton,keys,lengths,fold,overlap,max_match,literals
+
+    fold=parse_arg.insensitive
+    regex=automaton=keys=lengths=None
+    try:
+        if parse_arg.pattern_file:
+            with open(parse_arg.pattern_file,encoding="utf-8") as f:
+                literals={bytes(line.strip(),"utf-8") for line in f 
+                    if line.strip()}
+        elif not parse_arg.insensitive:
+            literals={bytes(parse_arg.pattern,"ISO-8859-1")}
+        else:
+            regex=re.compile(bytes(parse_arg.pattern,"utf-8"),re.IGNORECASE)
+            overlap=max(len(parse_arg.pattern),max_match)
+            literals=None
+            return
+    except (OSError, UnicodeError, re.error) as err:
+        print("Error: cannot use pattern: %s" % err)
+        sys.exit()
+
+    if not literals:
+        print("Error: no patterns in '%s'!" % parse_arg.pattern_file)
+        sys.exit()
+
+    literals=sorted(literals,key=len,reverse=True)
+    overlap=len(literals[0])-1
+    # -i folds ASCII case only, as re does for bytes
+    keys=set(literal.lower() if fold else literal for literal in literals)
+    lengths=sorted(set(len(key) for key in keys))
+    if ahocorasick:
+        automaton=ahocorasick.Automaton()
+        for key in keys:
+            automaton.add_word(key.decode("ISO-8859-1"),len(key))
+        automaton.make_automaton()
+    else:
+        # at every position the lookahead captures the longest literal,
+        # the shorter ones there are its prefixes in keys
+        regex=re.compile(b'(?=('+literal_trie(sorted(keys))+b'))',
+            re.IGNORECASE if fold else 0)
+
+# start and end of the matches in window from start, by start
+def find_matches(window,start):
+    global regex,automaton,keys,lengths,fold
+
+    if automaton is not None:
+        text=(window.lower() if fold else window).decode("ISO-8859-1")
+        yield from sorted((end+1-length,end+1) 
+            for end,length in automaton.iter(text,start))
+    elif keys is not None:
+        for m_o in regex.finditer(window,start):
+            found=m_o.group(1).lower() if fold else m_o.group(1)
+            for length in lengths:
+                if length>len(found):
+                    break
+                if found[:length] in keys:
+                    yield m_o.start(),m_o.start()+length
+    else:
+        for m_o in regex.finditer(window,start):
+            yield m_o.span()
+
+def match_name(name):
+    return next(find_matches(name.encode("utf-8"),0),None) is not None
+
+def print_match(object,window,base,offset,end,range=25):
+    print("%s: matched at offset %d" % (object,base+offset),flush=True)
+    excerpt=window[max(0,offset-range):end+range]
+    print('\t'+repr(excerpt.decode(encoding="ISO-8859-1")))
+
+# search the chunks of body for every occurrence, a window is searched up
+# to where a match could still run into the next chunk plus the excerpt
+# after it, the rest is kept; stops downloading after limit matches if
+# limit is set and returns the number of matches
+def search_stream(object,body,parse_arg,limit,range=25):
+    global overlap,literals
+
+    report=not (parse_arg.files_with_matches or parse_arg.count)
+    window=b''
+    base=0
+    start=0
+    count=0
+    chunks=iter(body)
+    done=False
+    while not done:
+        chunk=next(chunks,None)
+        if chunk is None:
+            cut=len(window)
+            done=True
+        else:
+            if parse_arg.binary and not base and not window and \
+                is_binary_string(chunk):
+                break
+            window+=chunk
+            cut=len(window)-overlap-range
+            if cut<range:
+                continue
+
+        last=start
+        for offset,end in find_matches(window,start):
+            if offset>=cut:
+                break
+            count+=1
+            last=end
+            if report:
+                print_match(object,window,base,offset,end,range)
+            if limit and count>=limit:
+                done=True
+                break
+
+        if not done:
+            # keep the excerpt before the cut and everything after it,
+            # literal matches may overlap, regex matches don't
+            drop=cut-range
+            window=window[drop:]
+            base+=drop
+            start=(cut if literals else max(cut,last))-drop
+
+    if hasattr(body,'close'):
+        body.close()
+
+    return count
+
+# with --archives objects with these suffixes are decompressed by their
+# leading bytes and tar members are searched one by one, zip files are read
+# with range requests from their directory at the end
+archive_suffices=('.gz','.tgz','.bz2','.xz','.zst','.lz4','.tar','.zip')
+codec_magic=[
+    (b'\x1f\x8b',"gzip"),
+    (b'\x28\xb5\x2f\xfd',"zstd"),
+    (b'\x04\x22\x4d\x18',"lz4"),
+    (b'BZh',"bzip2"),
+    (b'\xfd7zXZ',"xz"),
+]
+codec_commands={
+    "zstd":["zstd","-q","-d","-c"],
+    "lz4":["lz4","-q","-d","-c"],
+}
+
+# readable file of an iterator of chunks
+class ChunkReader(io.RawIOBase):
+    def __init__(self,chunks):
+        self.chunks=iter(chunks)
+        self.pending=memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self,buffer):
+        while not self.pending:
+            chunk=next(self.chunks,None)
+            if chunk is None:
+                return 0
+            self.pending=memoryview(chunk)
+        size=min(len(buffer),len(self.pending))
+        buffer[:size]=self.pending[:size]
+        self.pending=self.pending[size:]
+        return size
+
+# seekable file of an object, every read is a range request
+class RangeReader(io.RawIOBase):
+    def __init__(self,sc,container,object,size):
+        self.sc=sc
+        self.container=container
+        self.object=object
+        self.size=size
+        self.pos=0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if whence==io.SEEK_CUR:
+            offset+=self.pos
+        elif whence==io.SEEK_END:
+            offset+=self.size
+        self.pos=offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self,buffer):
+        end=min(self.pos+len(buffer),self.size)
+        if end<=self.pos:
+            return 0
+        headers,data=self.sc.get_object(self.container,self.object,
+            headers={'Range':"bytes=%d-%d" % (self.pos,end-1)})
+        buffer[:len(data)]=data
+        self.pos+=len(data)
+        return len(data)
+
+def detect_codec(lead):
+    global codec_magic
+
+    for magic,name in codec_magic:
+        if lead.startswith(magic):
+            return name
+
+    return "none"
+
+def feed_chunks(pipe,chunks):
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except OSError:
+        pass
+    finally:
+        pipe.close()
+
+# first bytes of chunks and chunks starting over with them
+def lead_chunks(chunks,size):
+    chunks=iter(chunks)
+    lead=b''
+    for chunk in chunks:
+        lead+=chunk
+        if len(lead)>=size:
+            break
+
+    return lead,itertools.chain([lead],chunks)
+
+# decompressed data of chunks in pieces of at most chunk_size, by their
+# leading bytes
+def decompress_chunks(chunks):
+    global chunk_size,codec_commands
+
+    lead,chunks=lead_chunks(chunks,8)
+    codec=detect_codec(lead)
+
+    if codec in ("gzip","bzip2","xz"):
+        opener={"gzip":gzip.open,"bzip2":bz2.open,
+            "xz":lzma.open}[codec]
+        f=opener(ChunkReader(chunks))
+        yield from iter(lambda:f.read(chunk_size),b'')
+    elif codec in codec_commands:
+        proc=subprocess.Popen(codec_commands[codec],stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        threading.Thread(target=feed_chunks,args=(proc.stdin,chunks),
+            daemon=True).start()
+        try:
+            yield from iter(lambda:proc.stdout.read(chunk_size),b'')
+        finally:
+            proc.stdout.close()
+            if proc.wait()>0:
+                raise OSError('%s exited with %d' % 
+                    (codec_commands[codec][0],proc.returncode))
+    else:
+        yield from chunks
+
+# name and chunks of every member of a zip or tar file, or of the
+# decompressed data of anything else; members are named object!member
+def archive_members(sc,parse_arg,object):
+    global chunk_size
+
+    if object.lower().endswith('.zip'):
+        size=int(sc.head_object(parse_arg.container,object)['content-length'])
+        zip_file=zipfile.ZipFile(io.BufferedReader(RangeReader(sc,
+            parse_arg.container,object,size),chunk_size))
+        for info in zip_file.infolist():
+            if not info.is_dir():
+                with zip_file.open(info) as member:
+                    yield "%s!%s" % (object,info.filename),iter(
+                        functools.partial(member.read,chunk_size),b'')
+        return
+
+    headers,body=sc.get_object(parse_arg.container,object,
+        resp_chunk_size=chunk_size)
+    try:
+        lead,data=lead_chunks(decompress_chunks(body),512)
+        if lead[257:262]!=b'ustar':
+            yield object,data
+            return
+        tar=tarfile.open(fileobj=ChunkReader(data),mode='r|')
+        for info in tar:
+            if info.isfile():
+                member=tar.extractfile(info)
+                yield "%s!%s" % (object,info.name),iter(
+                    functools.partial(member.read,chunk_size),b'')
+    finally:
+        body.close()
+
+# name and chunks of what is searched in an object, its members with
+# --archives
+def object_members(sc,parse_arg,object):
+    global chunk_size,archive_suffices
+
+    if parse_arg.archives and object.lower().endswith(archive_suffices):
+        yield from archive_members(sc,parse_arg,object)
+        return
+
+    headers,body=sc.get_object(parse_arg.container,object,
+        resp_chunk_size=chunk_size)
+    try:
+        yield object,body
+    finally:
+        if hasattr(body,'close'):
+            body.close()
+
+# errors reading an object or one of its archive members
+read_errors=(OSError, EOFError, ValueError, RuntimeError, NotImplementedError,
+    tarfile.TarError, zipfile.BadZipFile, swiftclient.ClientException)
 
 def search_object(parse_arg,object):
+    global read_errors
+
     sc=create_sw_conn(parse_arg.authtoken,parse_arg.storage_url)
 
-    match=object.find(parse_arg.pattern)
-    if match!=-1:
+    if match_name(object):
        print("%s: matched object name" % object,flush=True)
 
-    headers,body=sc.get_object(parse_arg.container,object)
-    if not parse_arg.binary or not is_binary_string(body):
-        #print("scanning object",object,flush=True)
-        if not parse_arg.insensitive:
-            print_match(object,body,bytes(parse_arg.pattern,"ISO-8859-1"))
-        else:
-            m_o=re.search(bytes(parse_arg.pattern,"utf-8"),body,re.IGNORECASE)
-            if m_o:
-                print_match(object,body,m_o.group(0))
+    # stop reading once -l or --max-count is answered
+    limit=1 if parse_arg.files_with_matches else parse_arg.max_count
+    count=0
+    members=object_members(sc,parse_arg,object)
+    try:
+        # with -b the first chunk decides whether a member is binary
+        for name,chunks in members:
+            count+=search_stream(name,chunks,parse_arg,limit and limit-count)
+            if limit and count>=limit:
+                break
+    except read_errors as err:
+        print("Error: cannot search '%s': %s" % (object,err),flush=True)
+    finally:
+        members.close()
+
+    if count and parse_arg.files_with_matches:
+        print(object,flush=True)
+    elif count and parse_arg.count:
+        print("%s: %d matches" % (object,count),flush=True)
 
     sc.close()
 
+# with --index the trigrams of every object, ASCII lowercased, are kept in
+# a SQLite file per container keyed by the object etag; only new or changed
+# objects are read to update it, and only objects holding all trigrams of
+# at least one literal pattern are searched. An object with more than
+# max_grams distinct trigrams is left unindexed and always searched.
+index_dir=os.path.join(os.path.expanduser("~"),".swsearch")
+max_grams=262144
+# trigrams of a pattern looked up, enough to narrow it down
+max_query_grams=64
+gram_regex=re.compile(b'(?=(...))',re.DOTALL)
+
+def pattern_grams(data):
+    global gram_regex
+
+    return set(gram_regex.findall(data.lower()))
+
+# order is parse_arg,object,etag; returns [object, etag or None if it could
+# not be read, trigrams as integers or None if unindexed]
+def index_worker(item):
+    global max_grams,read_errors
+
+    parse_arg,object,etag=item
+    sc=create_sw_conn(parse_arg.authtoken,parse_arg.storage_url)
+
+    grams=set()
+    members=object_members(sc,parse_arg,object)
+    try:
+        for name,chunks in members:
+            # the last two bytes of a chunk start trigrams in the next
+            carry=b''
+            for chunk in chunks:
+                data=carry+chunk
+                grams.update(pattern_grams(data))
+                carry=data[-2:]
+                if len(grams)>max_grams:
+                    return [object,etag,None]
+    except read_errors as err:
+        print("Error: cannot index '%s': %s" % (object,err),flush=True)
+        return [object,None,None]
+    finally:
+        members.close()
+        sc.close()
+
+    return [object,etag,[int.from_bytes(gram,"big") for gram in grams]]
+
+def open_index(path):
+    db=sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS objects (id INTEGER PRIMARY KEY,"
+        " name TEXT UNIQUE, etag TEXT, indexed INTEGER, archives INTEGER)")
+    # indexes from before archives was recorded get it added as NULL, so
+    # their objects are indexed again
+    if "archives" not in [row[1] for row in
+        db.execute("PRAGMA table_info(objects)")]:
+        db.execute("ALTER TABLE objects ADD COLUMN archives INTEGER")
+    db.execute("CREATE TABLE IF NOT EXISTS postings (gram INTEGER,"
+        " object INTEGER, PRIMARY KEY (gram,object)) WITHOUT ROWID")
+    db.execute("CREATE INDEX IF NOT EXISTS postings_object ON postings"
+        " (object)")
+    return db
+
+def drop_object(db,id):
+    db.execute("DELETE FROM postings WHERE object=?",[id])
+    db.execute("DELETE FROM objects WHERE id=?",[id])
+
+# bring the index up to date with objs, reading only objects whose etag
+# changed or that were indexed with or without --archives unlike this run;
+# objects no longer in listed are dropped
+def update_index(db,pool,parse_arg,objs,listed):
+    archives=int(parse_arg.archives)
+    known=dict((name,[id,etag,mode]) for id,name,etag,mode in 
+        db.execute("SELECT id,name,etag,archives FROM objects"))
+    for name,(id,etag,mode) in known.items():
+        if name not in listed:
+            drop_object(db,id)
+    db.commit()
+
+    changed=[[parse_arg,obj['name'],obj['hash']] for obj in objs 
+        if known.get(obj['name'],[None,None,None])[1:]!=
+            [obj['hash'],archives]]
+    for object,etag,grams in pool.imap_unordered(index_worker,changed):
+        if object in known:
+            drop_object(db,known[object][0])
+        id=db.execute("INSERT INTO objects (name,etag,indexed,archives)"
+            " VALUES (?,?,?,?)",[object,etag,grams is not None,
+            archives]).lastrowid
+        if grams:
+            db.executemany("INSERT INTO postings VALUES (?,?)",
+                ((gram,id) for gram in grams))
+        db.commit()
+
+    print("Index: %d of %d objects updated" % (len(changed),len(objs)),
+        file=sys.stderr)
+
+# names of objects that may hold a match, None when the patterns can't be
+# narrowed down by trigrams
+def index_candidates(db):
+    global literals,max_query_grams
+
+    if not literals or min(len(literal) for literal in literals)<3:
+        return None
+
+    ids=set(id for id, in db.execute(
+        "SELECT id FROM objects WHERE NOT indexed"))
+    for literal in literals:
+        grams=[int.from_bytes(gram,"big") for gram in 
+            sorted(pattern_grams(literal))[:max_query_grams]]
+        ids.update(id for id, in db.execute(
+            "SELECT object FROM postings WHERE gram IN (%s) GROUP BY object"
+            " HAVING COUNT(*)=?" % ",".join("?"*len(grams)),
+            grams+[len(grams)]))
+
+    return set(name for id,name in db.execute("SELECT id,name FROM objects")
+        if id in ids)
+
 # order is type,sc,container,object,pattern
 def search_worker(item):
     search_object(*item)
@@ -68,10 +539,10 @@ skip_suffices=tuple(['.bam','.gz','.tif','.nc','.fcs','.dv','.mov','.bin',\
     '.gif','.pyc','.ithmb','.wav','.pgm'])
 
 def search_container(parse_arg):
-    global skip_suffices
+    global skip_suffices,archive_suffices,index_dir
 
-    # changed from obsolete psutil.phymem_usage().available
-    memavail=psutil.virtual_memory().available
+    # compiled here once, the workers inherit it
+    compile_patterns(parse_arg)
 
     sc=create_sw_conn(parse_arg.authtoken,parse_arg.storage_url)
 
@@ -84,15 +555,38 @@ def search_container(parse_arg):
 
         search_pool=multiprocessing.Pool(parse_arg.maxproc)
 
+        selected=[]
         for obj in objs:
-            if obj['name'].lower().endswith(skip_suffices) or\
+            if (obj['name'].lower().endswith(skip_suffices) and not \
+                (parse_arg.archives and \
+                    obj['name'].lower().endswith(archive_suffices))) or\
                 (parse_arg.filename and not \
                     fnmatch.fnmatch(obj['name'],parse_arg.filename)):
                     continue
-
-            if obj['bytes']>memavail:
-                print("Object",obj['name'],"too large for memory!",
-                    file=sys.stderr)
+            selected.append(obj)
+
+        candidates=None
+        if parse_arg.index is not None:
+            path=parse_arg.index
+            if not path:
+                os.makedirs(index_dir,exist_ok=True)
+                path=os.path.join(index_dir,parse_arg.container+".db")
+            db=open_index(path)
+            # with a prefix only objects under it are known to be gone
+            listed=set(obj['name'] for obj in objs)
+            if parse_arg.prefix:
+                listed.update(name for name, in 
+                    db.execute("SELECT name FROM objects") 
+                    if not name.startswith(parse_arg.prefix))
+            update_index(db,search_pool,parse_arg,selected,listed)
+            candidates=index_candidates(db)
+            db.close()
+
+        for obj in selected:
+            if candidates is not None and obj['name'] not in candidates:
+                # the name may still match
+                if match_name(obj['name']):
+                    print("%s: matched object name" % obj['name'],flush=True)
                 continue
 
             search_pool.apply_async(search_worker,[[parse_arg,obj['name']]])
@@ -111,7 +605,7 @@ def parse_arguments():
     parser=argparse.ArgumentParser(
         description="Search text objects for pattern")
     parser.add_argument('-c','--container',required=True)
-    parser.add_argument('pattern',type=str)
+    parser.add_argument('pattern',type=str,nargs='?')
     parser.add_argument('-m','--maxproc',type=int,
         help="maximum number of processes to run",default=5)
     parser.add_argument('-a','--authtoken',
@@ -128,8 +622,28 @@ def parse_arguments():
         help='try to exclude files identified as binary')
     parser.add_argument('-i','--insensitive',action='store_true',
         help='case insensitive search')
-
-    return parser.parse_args()
+    parser.add_argument('-F','--pattern-file',
+        help='search for every literal string in this file, one per line,'
+            ' faster with pyahocorasick installed')
+    parser.add_argument('-l','--files-with-matches',action='store_true',
+        help='only list objects that match, stop reading each at its first'
+            ' match')
+    parser.add_argument('-n','--count',action='store_true',
+        help='only print the number of matches in each object')
+    parser.add_argument('-M','--max-count',type=int,default=0,
+        help='stop reading an object after this many matches')
+    parser.add_argument('-z','--archives',action='store_true',
+        help='search inside compressed objects, tar files such as swbundler'
+            ' bundles and zip files')
+    parser.add_argument('-x','--index',nargs='?',const='',metavar='DB',
+        help='keep a trigram index of the container in DB (default '
+            '~/.swsearch/container.db) and only search objects it allows')
+
+    parse_arg=parser.parse_args()
+    if not parse_arg.pattern and not parse_arg.pattern_file:
+        parser.error("a pattern or --pattern-file is required")
+
+    return parse_arg
 
 def main():
     search_container(parse_arguments())
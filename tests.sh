@@ -10,6 +10,14 @@ swc archive /var/log/samba /swift-commmander-tests/log.archive
 swc unarch /swift-commmander-tests/log.archive ./tests/log.archive
 swc search samba /swift-commmander-tests
 swc compare ./tests/log ./tests/log.archive
+# bundles with a gzip member per tar member, restored by the python engine
+swbundler.py --engine=python --index-members -l /var/log/samba -c swift-commmander-tests -p log.framed
+mkdir -p ./tests/log.framed ./tests/log.framed.stream
+swbundler.py -x --engine=python -l ./tests/log.framed -c swift-commmander-tests -p log.framed
+swbundler.py -x --engine=python --stream -l ./tests/log.framed.stream -c swift-commmander-tests -p log.framed
+swc compare ./tests/log ./tests/log.framed
+swc compare ./tests/log ./tests/log.framed.stream
+swc rm -rf /swift-commmander-tests/log.framed
 swc rm -rf /swift-commmander-tests/log.archive
 swc rm -rf /swift-commmander-tests/log
 swc ls /swift-commmander-tests